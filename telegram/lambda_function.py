@@ -10,19 +10,131 @@ Esta función maneja todas las interacciones del bot de Telegram, incluyendo:
 
 """
 
+import os
 import time
-from datetime import datetime
+import concurrent.futures
+import functools
+from dataclasses import dataclass, field
+from datetime import date
+from types import MappingProxyType
 import json
-from urllib.request import Request, urlopen
-from urllib.parse import urlencode, quote, parse_qs
-from urllib.error import URLError, HTTPError
+import logging
+from urllib.parse import urlencode, quote, parse_qs, urljoin
 import re
 import boto3
 import base64
-from boto3.dynamodb.types import Binary
-
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table('telegram')
+import urllib3
+from urllib3.exceptions import HTTPError
+from botocore.config import Config
+from boto3.dynamodb.types import Binary, TypeSerializer, TypeDeserializer
+
+# orjson es opcional: si está empaquetado con la Lambda se usa para el JSON del camino caliente.
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+    _loads = json.loads
+
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+TABLA_USUARIOS = 'telegram'
+
+# Cliente de bajo nivel de DynamoDB (sin la capa Resource), creado una sola vez por contenedor.
+_CFG = Config(tcp_keepalive=True, max_pool_connections=4, retries={'max_attempts': 2, 'mode': 'standard'})
+DDB = boto3.client('dynamodb', config=_CFG)
+_serializar = TypeSerializer().serialize
+_deserializar = TypeDeserializer().deserialize
+
+def _deserializar_item(item):
+    """
+    Convierte un item de DynamoDB a dict de Python, decodificando una sola vez
+    los atributos binarios (B) a str para que el resto del flujo no los trate.
+    
+    Args:
+        item (dict): Item en formato de bajo nivel de DynamoDB
+        
+    Returns:
+        dict: Item con valores nativos de Python
+    """
+    datos = {}
+    for clave, valor in item.items():
+        valor = _deserializar(valor)
+        if isinstance(valor, Binary):
+            valor = valor.value
+        if isinstance(valor, bytes):
+            valor = valor.decode('utf-8')
+        datos[clave] = valor
+    return datos
+
+_BOLD_RE = re.compile(r'\*(.*?)\*')
+_EMAIL_RE = re.compile(r"[^@]+@[^@]+\.[^@]+")
+# DD-MM-YYYY o DD/MM/YYYY (el mismo separador en ambas posiciones)
+_DATE_RE = re.compile(r'^\s*([0-9]{1,2})([-/])([0-9]{1,2})\2([0-9]{4})\s*$')
+_PARENTESCOS = frozenset(("madre", "padre", "esposo", "esposa", "hijo", "hija", "hermano", "hermana"))
+
+# Botones y menús fijos. Sólo se leen para construir el teclado, así que se
+# comparten entre mensajes en vistas de solo lectura en lugar de recrearlos.
+_BOTONES_SI_NO = MappingProxyType({"Si": "Si", "No": "No"})
+_BOTONES_SI_NO_COTIZAR = MappingProxyType({"Si": "Si", "No": "No", "Cotiza": "Volver a cotizar"})
+_BOTONES_SI_NO_VOLVER = MappingProxyType({"Si": "Si", "No": "No", "Cotiza": "Volver"})
+_BOTONES_CONTINUAR = MappingProxyType({"Continuar": "Continuar"})
+_BOTONES_GENERO = MappingProxyType({"M": "Masculino", "F": "Femenino"})
+
+_OPCIONES_AREAS = ("Riesgos", "Soporte al Cliente", "Administracion", "Hablar con TUBOT")
+_OPCIONES_ROLES = ("Usuario", "Asociado", "Master")
+_OPCIONES_ROLES_DEV = _OPCIONES_ROLES + ("Desarrollador",)
+_SUBOPCIONES = MappingProxyType({
+    'administracion': ("Aranceles", "Relacion Comisiones", "Pago Comisiones", "Contacto"),
+    'riesgos': ("Condicionados", "Métodos Pago", "Requisitos Cotizar", "Requisitos Emitir", "Requ. cotizar colectivo", "Requ. cotizar flota", "Solicitudes", 'Edad de admisibilidad', 'Plazos de espera'),
+    'soporte al cliente': ("Red clinicas", "Proc. Reclamos", "Tramitar Recl.", "Contactos Emerg."),
+})
+_COMPANIAS = tuple(f'Compania{i}' for i in range(1, 11))
+_COMPANIAS_POR_SUBCATEGORIA = MappingProxyType(
+    {subcategoria: _COMPANIAS for subcategoria in ('condicionados', 'red clinicas', 'métodos pago', 'solicitudes')}
+)
+# Categorías del menú de asociados y subcategorías que piden elegir aseguradora.
+_CATEGORIAS = frozenset(_SUBOPCIONES)
+_SUBCATEGORIAS_COMPANIA = frozenset(_COMPANIAS_POR_SUBCATEGORIA)
+
+# Respuestas reconocidas en additionalHelp y confirmContinue.
+_VOLVER_TOKENS = frozenset(('volver a cotizar', 'volver'))
+_AFFIRMATIVE = frozenset(('si', 'sí', 's', 'yes'))
+_NEGATIVE = frozenset(('no', 'n'))
+_ROLES_ADMIN = frozenset(('admin', 'developer'))
+
+# Modelo de GPT cuando el usuario no tiene uno configurado.
+_MODELO_DEFAULT = "gpt-4o"
+
+# Pool de conexiones HTTP compartido entre invocaciones "calientes" de la Lambda,
+# reutiliza las conexiones keep-alive hacia Telegram y los servicios externos.
+HTTP = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=8,
+    retries=urllib3.Retry(total=2, backoff_factor=0.1),
+    headers={'Connection': 'keep-alive'}
+)
+
+_HDR_FORM = {'Content-Type': 'application/x-www-form-urlencoded'}
+_HDR_JSON = {'Content-Type': 'application/json'}
+_TG = "https://api.telegram.org/bot" + os.environ.get('TG_TOKEN', 'YOUR_TELEGRAM_BOT_TOKEN')
+_URL_SEND_MSG = _TG + "/sendMessage"
+_URL_SEND_DOC = _TG + "/sendDocument"
+
+# Hilos para solapar envíos a Telegram con el resto del trabajo de la invocación.
+_EXEC = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+# Abre las conexiones TLS a DynamoDB y Telegram durante la fase INIT de la Lambda,
+# para que la primera invocación no pague el handshake.
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+    try:
+        DDB.describe_table(TableName=TABLA_USUARIOS)
+        HTTP.request('HEAD', 'https://api.telegram.org/', timeout=1.0, retries=False)
+    except Exception as e:
+        print(f"Error al precalentar conexiones: {e}")
 
 def guardar_usuario(user_id, user_data):
     """
@@ -32,22 +144,126 @@ def guardar_usuario(user_id, user_data):
         user_id (str): ID único del usuario
         user_data (dict): Datos del usuario a guardar
     """
-    table.put_item(Item={'userID': user_id, **user_data})
+    item = {'userID': user_id, **user_data}
+    DDB.put_item(TableName=TABLA_USUARIOS, Item={k: _serializar(v) for k, v in item.items()})
 
-def recuperar_usuario(user_id):
+def recuperar_usuario(user_id, projection=None):
     """
     Recupera los datos de un usuario desde DynamoDB.
     
     Args:
         user_id (str): ID único del usuario
+        projection (iterable): Atributos a leer (opcional, por defecto todos)
         
     Returns:
         dict: Datos del usuario o None si no existe
     """
-    response = table.get_item(Key={'userID': user_id})
-    user_data = response.get('Item', None)
-    if user_data:
-        return user_data
+    kwargs = {}
+    if projection:
+        nombres = {f'#p{i}': clave for i, clave in enumerate(projection)}
+        kwargs['ProjectionExpression'] = ', '.join(nombres)
+        kwargs['ExpressionAttributeNames'] = nombres
+    response = DDB.get_item(TableName=TABLA_USUARIOS, Key={'userID': {'S': user_id}}, **kwargs)
+    item = response.get('Item', None)
+    if item:
+        return _deserializar_item(item)
+
+# Valores por defecto de los atributos que el flujo de conversación lee siempre.
+_USUARIO_DEFAULTS = {
+    'step': 'start',
+    'monto': '',
+    'nombre': '',
+    'fecha': '',
+    'modo': 'normal',
+    'cotiza': '',
+    'rol': 'user',
+    'master': 'OFF',
+    'developer': 'OFF'
+}
+
+def _normalizar_usuario(usuario):
+    """
+    Completa un usuario con los valores por defecto de los atributos que falten.
+    
+    Args:
+        usuario (dict): Datos del usuario tal como vienen de DynamoDB
+        
+    Returns:
+        dict: Datos del usuario con todos los atributos de _USUARIO_DEFAULTS
+    """
+    return {**_USUARIO_DEFAULTS, **usuario}
+
+def _actualizar_usuario(user_id, set_map, remove_keys=(), condicion='attribute_exists(userID)'):
+    """
+    Actualiza atributos de un usuario con un único UpdateItem en DynamoDB.
+    
+    Args:
+        user_id (str): ID único del usuario
+        set_map (dict): Atributos a asignar
+        remove_keys (iterable): Atributos a eliminar
+        condicion (str): ConditionExpression que debe cumplirse para escribir
+        
+    Returns:
+        dict: Datos del usuario tras la actualización o None si no se cumple la condición
+    """
+    nombres = {}
+    valores = {}
+    asignaciones = []
+    for i, (clave, valor) in enumerate(set_map.items()):
+        nombres[f'#s{i}'] = clave
+        valores[f':s{i}'] = _serializar(valor)
+        asignaciones.append(f'#s{i} = :s{i}')
+    expresion = 'SET ' + ', '.join(asignaciones)
+    if remove_keys:
+        eliminaciones = []
+        for i, clave in enumerate(remove_keys):
+            nombres[f'#r{i}'] = clave
+            eliminaciones.append(f'#r{i}')
+        expresion += ' REMOVE ' + ', '.join(eliminaciones)
+
+    try:
+        response = DDB.update_item(
+            TableName=TABLA_USUARIOS,
+            Key={'userID': {'S': user_id}},
+            UpdateExpression=expresion,
+            ConditionExpression=condicion,
+            ExpressionAttributeNames=nombres,
+            ExpressionAttributeValues=valores,
+            ReturnValues='ALL_NEW'
+        )
+    except DDB.exceptions.ConditionalCheckFailedException:
+        return None
+    return _deserializar_item(response['Attributes'])
+
+def _inicializar_usuario(user_id, nombre):
+    """
+    Crea el registro de un usuario nuevo con una escritura condicional.
+    
+    Args:
+        user_id (str): ID único del usuario
+        nombre (str): Nombre del perfil de Telegram
+        
+    Returns:
+        dict: Datos del usuario creado, o los ya existentes si otra invocación se adelantó
+    """
+    usuario = {'step': 'start', 'monto': '', 'nombre': nombre, 'fecha': '', 'modo': 'normal',  'cotiza': ''}
+    return _actualizar_usuario(user_id, usuario, condicion='attribute_not_exists(userID)') or recuperar_usuario(user_id)
+
+# Longitud máxima de un nombre escrito por el usuario.
+_MAX_NOMBRE = 60
+
+def _normalizar_nombre(texto):
+    """
+    Normaliza un nombre escrito por el usuario: colapsa los espacios,
+    capitaliza cada palabra y recorta a _MAX_NOMBRE caracteres.
+    
+    Args:
+        texto (str): Nombre tal como lo escribió el usuario
+        
+    Returns:
+        str: Nombre normalizado
+    """
+    return ' '.join(texto.split()).title()[:_MAX_NOMBRE].rstrip()
 
 def correo_es_valido(correo):
     """
@@ -61,8 +277,10 @@ def correo_es_valido(correo):
     """
     if isinstance(correo, bytes):
         correo = correo.decode('utf-8')
-    patron = r"[^@]+@[^@]+\.[^@]+"
-    return re.match(patron, correo)
+    # Filtro barato antes de la expresión regular: exactamente una arroba.
+    if correo.count('@') != 1:
+        return False
+    return _EMAIL_RE.match(correo) is not None
 
 def validar_fecha(cadena_fecha):
     """
@@ -74,16 +292,14 @@ def validar_fecha(cadena_fecha):
     Returns:
         date: Objeto date si es válida, None en caso contrario
     """
-    try:
-        fecha_obj = datetime.strptime(cadena_fecha, '%d-%m-%Y')
-        return fecha_obj.date()
-    except ValueError:
+    m = _DATE_RE.match(cadena_fecha)
+    if m:
         try:
-            fecha_obj = datetime.strptime(cadena_fecha, '%d/%m/%Y')
-            return fecha_obj.date()
+            return date(int(m.group(4)), int(m.group(3)), int(m.group(1)))
         except ValueError:
-            print (cadena_fecha, " es una fecha invalida")
-            return None
+            pass
+    print (cadena_fecha, " es una fecha invalida")
+    return None
 
 def fecha_sql(cadena_fecha):
     """
@@ -95,16 +311,10 @@ def fecha_sql(cadena_fecha):
     Returns:
         str: Fecha en formato SQL o None si es inválida
     """
-    for formato in ('%d-%m-%Y', '%d/%m/%Y'):
-        try:
-            fecha_obj = datetime.strptime(cadena_fecha, formato).date()
-            return fecha_obj.strftime('%Y-%m-%d')
-        except ValueError:
-            continue
-    print(cadena_fecha, "es una fecha inválida")
-    return None
+    fecha_obj = validar_fecha(cadena_fecha)
+    return fecha_obj.isoformat() if fecha_obj else None
 
-def pregunta_a_chatgpt(mensaje, model="gpt-4o"):
+def pregunta_a_chatgpt(mensaje, model=_MODELO_DEFAULT):
     """
     Envía una pregunta al servicio ChatGPT y obtiene la respuesta.
     
@@ -118,25 +328,23 @@ def pregunta_a_chatgpt(mensaje, model="gpt-4o"):
     if isinstance(mensaje, bytes):
         mensaje = mensaje.decode('utf-8')
     url_node_script = "https://YOUR_CHATGPT_API_ENDPOINT/chatgpt"
-    headers = {'Content-Type': 'application/json'}
     data = {"message": mensaje, "model": model}
 
     try:
-        req = Request(url_node_script, json.dumps(data).encode('utf-8'), headers)
-        with urlopen(req) as response:
-            respuesta_json = json.load(response)
-            return respuesta_json.get('reply', 'No se pudo obtener una respuesta.')
+        response = HTTP.request('POST', url_node_script, body=_dumps(data), headers=_HDR_JSON)
+        if response.status >= 400:
+            print(f"Error HTTP al enviar la pregunta: {response.status} {response.reason}")
+            return "Hubo un problema al procesar tu pregunta."
+        respuesta_json = _loads(response.data)
+        return respuesta_json.get('reply', 'No se pudo obtener una respuesta.')
     except HTTPError as e:
-        print(f"Error HTTP al enviar la pregunta: {e}")
-        return "Hubo un problema al procesar tu pregunta."
-    except URLError as e:
         print(f"Error de URL al enviar la pregunta: {e}")
         return "Error al procesar la pregunta."
     except Exception as e:
         print(f"Error al enviar la pregunta: {e}")
         return "Error al procesar la pregunta."
 
-def pregunta_a_gandalf(mensaje, model="gpt-4o"):
+def pregunta_a_gandalf(mensaje, model=_MODELO_DEFAULT):
     """
     Envía una pregunta al servicio Gandalf (modo desarrollador) y obtiene la respuesta.
     
@@ -150,18 +358,16 @@ def pregunta_a_gandalf(mensaje, model="gpt-4o"):
     if isinstance(mensaje, bytes):
         mensaje = mensaje.decode('utf-8')
     url_node_script = "https://YOUR_GANDALF_API_ENDPOINT/gandalf"
-    headers = {'Content-Type': 'application/json'}
     data = {"message": mensaje, "model": model}
 
     try:
-        req = Request(url_node_script, json.dumps(data).encode('utf-8'), headers)
-        with urlopen(req) as response:
-            respuesta_json = json.load(response)
-            return respuesta_json.get('reply', 'No se pudo obtener una respuesta.')
+        response = HTTP.request('POST', url_node_script, body=_dumps(data), headers=_HDR_JSON)
+        if response.status >= 400:
+            print(f"Error HTTP al enviar la pregunta: {response.status} {response.reason}")
+            return "Hubo un problema al procesar tu pregunta."
+        respuesta_json = _loads(response.data)
+        return respuesta_json.get('reply', 'No se pudo obtener una respuesta.')
     except HTTPError as e:
-        print(f"Error HTTP al enviar la pregunta: {e}")
-        return "Hubo un problema al procesar tu pregunta."
-    except URLError as e:
         print(f"Error de URL al enviar la pregunta: {e}")
         return "Error al procesar la pregunta."
     except Exception as e:
@@ -172,6 +378,38 @@ def modelo_es_valido(model):
     return isinstance(model, str) and bool(model.strip())
 
 
+@functools.lru_cache(maxsize=128)
+def _teclado_inline(botones):
+    """
+    Construye el reply_markup de botones inline; los menús repetidos salen de la caché.
+    
+    Args:
+        botones (tuple): Pares (boton_id, titulo)
+        
+    Returns:
+        dict: reply_markup compartido, no debe modificarse
+    """
+    return {
+        'inline_keyboard': [[{'text': titulo, 'callback_data': boton_id} for boton_id, titulo in botones]]
+    }
+
+@functools.lru_cache(maxsize=128)
+def _teclado_opciones(opciones):
+    """
+    Construye el reply_markup de teclado de opciones; los menús repetidos salen de la caché.
+    
+    Args:
+        opciones (tuple): Textos de las opciones
+        
+    Returns:
+        dict: reply_markup compartido, no debe modificarse
+    """
+    return {
+        'keyboard': [[{'text': opcion} for opcion in opciones]],
+        'one_time_keyboard': True,
+        'resize_keyboard': True
+    }
+
 def enviar_mensaje_telegram(chat_id, mensaje, botones=None, url_pdf=None, pdf_file=None, opciones=None):
     """
     Envía un mensaje a Telegram con diferentes opciones de formato.
@@ -187,14 +425,16 @@ def enviar_mensaje_telegram(chat_id, mensaje, botones=None, url_pdf=None, pdf_fi
     Returns:
         dict: Respuesta de la API de Telegram
     """
-    mensaje = re.sub(r'\*(.*?)\*', r'<b>\1</b>', mensaje)
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    
+    if '*' in mensaje:
+        partes = mensaje.split('*')
+        # Con asteriscos pareados y sin saltos de línea el resultado es el mismo que el de la regex
+        if len(partes) % 2 == 1 and '\n' not in mensaje:
+            mensaje = ''.join(p if i % 2 == 0 else f'<b>{p}</b>' for i, p in enumerate(partes))
+        else:
+            mensaje = _BOLD_RE.sub(r'<b>\1</b>', mensaje)
     # Enviar mensaje con PDF
     if url_pdf:
-        url = f'https://api.telegram.org/botYOUR_TELEGRAM_BOT_TOKEN/sendDocument'
+        url = _URL_SEND_DOC
         data = {
             'chat_id': chat_id,
             'document': url_pdf,
@@ -204,10 +444,8 @@ def enviar_mensaje_telegram(chat_id, mensaje, botones=None, url_pdf=None, pdf_fi
     
     # Enviar mensaje con botones
     elif botones:
-        url = f'https://api.telegram.org/botYOUR_TELEGRAM_BOT_TOKEN/sendMessage'
-        reply_markup = {
-            'inline_keyboard': [[{'text': titulo, 'callback_data': boton_id} for boton_id, titulo in botones.items()]]
-        }
+        url = _URL_SEND_MSG
+        reply_markup = _teclado_inline(tuple(botones.items()))
         data = {
             'chat_id': chat_id,
             'text': mensaje,
@@ -217,12 +455,8 @@ def enviar_mensaje_telegram(chat_id, mensaje, botones=None, url_pdf=None, pdf_fi
     
     # Enviar mensaje con opciones
     elif opciones:
-        url = f'https://api.telegram.org/botYOUR_TELEGRAM_BOT_TOKEN/sendMessage'
-        reply_markup = {
-            'keyboard': [[{'text': opcion} for opcion in opciones]],
-            'one_time_keyboard': True,
-            'resize_keyboard': True
-        }
+        url = _URL_SEND_MSG
+        reply_markup = _teclado_opciones(tuple(opciones))
         data = {
             'chat_id': chat_id,
             'text': mensaje,
@@ -232,7 +466,7 @@ def enviar_mensaje_telegram(chat_id, mensaje, botones=None, url_pdf=None, pdf_fi
     
     # Enviar mensaje de texto simple
     else:
-        url = f'https://api.telegram.org/botYOUR_TELEGRAM_BOT_TOKEN/sendMessage'
+        url = _URL_SEND_MSG
         data = {
             'chat_id': chat_id,
             'text': mensaje,
@@ -240,21 +474,60 @@ def enviar_mensaje_telegram(chat_id, mensaje, botones=None, url_pdf=None, pdf_fi
         }
 
     try:
-        req = Request(url, json.dumps(data).encode('utf-8'), headers)
-        with urlopen(req) as response:
-            respuesta_json = json.load(response)
-            return respuesta_json
+        response = HTTP.request('POST', url, body=_dumps(data), headers=_HDR_JSON)
+        if response.status >= 400:
+            error_message = response.data.decode()
+            print(f"Error HTTP al enviar el mensaje: {response.status} {response.reason} {error_message}")
+            return {'error': 'Hubo un problema al enviar el mensaje.', 'details': error_message}
+        respuesta_json = _loads(response.data)
+        logger.debug("Respuesta de Telegram: %s", respuesta_json)
+        return respuesta_json
     except HTTPError as e:
-        error_message = e.read().decode()
-        print(f"Error HTTP al enviar el mensaje: {e.code} {e.reason} {error_message}")
-        return {'error': 'Hubo un problema al enviar el mensaje.', 'details': error_message}
-    except URLError as e:
-        print(f"Error de URL al enviar el mensaje: {e.reason}")
+        print(f"Error de URL al enviar el mensaje: {e}")
         return {'error': 'Error al procesar el mensaje.'}
     except Exception as e:
         print(f"Error general al enviar el mensaje: {e}")
         return {'error': 'Error al procesar el mensaje.'}
 
+def _enviar_async(*args):
+    """
+    Envía un mensaje a Telegram en segundo plano.
+    
+    Args:
+        *args: Argumentos de enviar_mensaje_telegram
+        
+    Returns:
+        Future: Futuro con la respuesta de la API de Telegram
+    """
+    return _EXEC.submit(enviar_mensaje_telegram, *args)
+
+def enviar_mensajes_telegram(chat_id, pendientes):
+    """
+    Envía varios mensajes a Telegram en orden, uno tras otro, reutilizando la
+    conexión keep-alive del pool en lugar de dormir entre envíos.
+    
+    Args:
+        chat_id (str): ID del chat de Telegram
+        pendientes (iterable): Tuplas (mensaje, botones, url_pdf, pdf_file, opciones)
+        
+    Returns:
+        list: Respuestas de la API de Telegram, en el mismo orden
+    """
+    return [enviar_mensaje_telegram(chat_id, *pendiente) for pendiente in pendientes]
+
+def _enviar_lote_async(chat_id, pendientes):
+    """
+    Envía un lote de mensajes en segundo plano conservando su orden.
+    
+    Args:
+        chat_id (str): ID del chat de Telegram
+        pendientes (list): Tuplas (mensaje, botones, url_pdf, pdf_file, opciones)
+        
+    Returns:
+        Future: Futuro con la lista de respuestas de la API de Telegram
+    """
+    return _EXEC.submit(enviar_mensajes_telegram, chat_id, pendientes)
+
 def obtener_boton(data_json, mensaje):
     """
     Extrae el dato del botón presionado desde el callback query.
@@ -266,13 +539,11 @@ def obtener_boton(data_json, mensaje):
     Returns:
         str: Dato del botón o mensaje original
     """
-    try:
-        if 'callback_query' in data_json:
-            callback_query = data_json['callback_query']
-            print("Botón:", callback_query['data'])
-            return callback_query['data']
-    except KeyError:
-        pass
+    callback_query = data_json.get('callback_query')
+    if callback_query and 'data' in callback_query:
+        boton = callback_query['data']
+        print("Botón:", boton)
+        return boton
 
     return mensaje
 
@@ -287,24 +558,87 @@ def obtener_contenido_pagina(url, params=None):
     Returns:
         str: Contenido de la página
     """
-    data = None
-    if params:
-        data = urlencode(params).encode('utf-8')  # Codifica los parámetros para la solicitud POST
-        req = Request(url, data=data, headers={"Content-Type": "application/x-www-form-urlencoded"})
-    else:
-        req = Request(url)
-
     try:
-        with urlopen(req) as response:
-            contenido = response.read().decode('utf-8')
-            return contenido
+        if params:
+            data = urlencode(params).encode('utf-8')  # Codifica los parámetros para la solicitud POST
+            response = HTTP.request('POST', url, body=data, headers=_HDR_FORM)
+        else:
+            response = HTTP.request('GET', url)
     except HTTPError as e:
-        print(f"HTTP Error: {e.code} - {e.reason}")
-        raise
-    except URLError as e:
-        print(f"URL Error: {e.reason}")
+        print(f"URL Error: {e}")
         raise
 
+    if response.status >= 400:
+        print(f"HTTP Error: {response.status} - {response.reason}")
+        raise HTTPError(f"{response.status} {response.reason}")
+    return response.data.decode('utf-8')
+
+# Pausas entre comprobaciones del PDF publicado (backoff exponencial). La espera
+# completa, incluidas las peticiones HEAD, nunca supera _PDF_ESPERA_MAX segundos.
+_PDF_ESPERAS = (0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+_PDF_ESPERA_MAX = 5.0
+_PDF_HEAD_TIMEOUT = 0.5
+_PDF_MAX_REDIRECCIONES = 2
+# Ningún reintento de ningún tipo (incluidos los errores "other", como un fallo
+# de TLS): cada intento lo decide el backoff de _esperar_pdf. Las redirecciones
+# se siguen a mano para que cada salto use sólo el tiempo que queda del plazo.
+_PDF_HEAD_RETRIES = urllib3.Retry(total=None, connect=0, read=0, status=0, other=0, redirect=0)
+
+def _pdf_disponible(url_pdf, limite):
+    """
+    Comprueba con un HEAD si el PDF ya se puede descargar, siguiendo hasta
+    _PDF_MAX_REDIRECCIONES redirecciones sin pasar del plazo.
+    
+    Args:
+        url_pdf (str): URL pública del PDF
+        limite (float): Instante límite según time.monotonic()
+        
+    Returns:
+        bool: True si el servidor lo sirve, False en caso contrario
+    """
+    try:
+        for _ in range(_PDF_MAX_REDIRECCIONES + 1):
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return False
+            response = HTTP.request('HEAD', url_pdf, timeout=urllib3.Timeout(total=min(_PDF_HEAD_TIMEOUT, restante)),
+                                    retries=_PDF_HEAD_RETRIES, redirect=False)
+            destino = response.get_redirect_location()
+            if not destino:
+                return response.status == 200
+            url_pdf = urljoin(url_pdf, destino)
+        return False
+    except HTTPError as e:
+        print(f"Error al comprobar el PDF: {e}")
+        return False
+    except Exception as e:
+        print(f"Error al comprobar el PDF: {str(e)}")
+        return False
+
+def _esperar_pdf(url_pdf):
+    """
+    Espera a que el PDF esté publicado antes de que Telegram intente descargarlo,
+    sondeando con backoff exponencial hasta un plazo de _PDF_ESPERA_MAX segundos.
+    
+    Args:
+        url_pdf (str): URL pública del PDF
+        
+    Returns:
+        bool: True si el PDF quedó disponible dentro del plazo
+    """
+    limite = time.monotonic() + _PDF_ESPERA_MAX
+    esperas = iter(_PDF_ESPERAS)
+    while True:
+        if _pdf_disponible(url_pdf, limite):
+            return True
+        restante = limite - time.monotonic()
+        espera = next(esperas, None)
+        if espera is None or restante <= 0:
+            break
+        time.sleep(min(espera, restante))
+    print("El PDF no está disponible todavía: ", url_pdf)
+    return False
+
 def generar_pdf(id_cotizacion):
     """
     Genera un PDF de cotización mediante servicio externo.
@@ -319,13 +653,12 @@ def generar_pdf(id_cotizacion):
         url = f"https://YOUR_PDF_SERVICE.co/pdfgen/gen.php?id={id_cotizacion}&zoom=0.65&orientation=Landscape&nofolder=1&server=YOUR_SERVER.co"
         contenido = obtener_contenido_pagina(url)
         print("PDF generado correctamente")
+        if id_cotizacion:
+            _esperar_pdf(f"https://YOUR_PDF_SERVICE.co/pdfgen/{id_cotizacion}.pdf")
         return contenido  # O maneja el contenido como necesites
     except HTTPError as e:
         print(f"Error al generar el PDF: {e}")
         raise
-    except URLError as e:
-        print(f"Error de conexión al generar el PDF: {e}")
-        raise
 
 def cotizar(datos):
     """
@@ -338,28 +671,38 @@ def cotizar(datos):
         str: ID de la cotización generada
     """
     url = "https://YOUR_QUOTE_SERVICE.co/app/chatbot/chatbot.php"
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
     
     data_encoded = urlencode(datos).encode('utf-8')
-    
-    req = Request(url, data=data_encoded, headers=headers)
 
     try:
-        with urlopen(req) as response:
-            response_text = response.read().decode('utf-8')
-            # Convertir la respuesta de JSON a un diccionario de Python
-            respuesta_json = json.loads(response_text)
-            return respuesta_json.get("id", "")
+        response = HTTP.request('POST', url, body=data_encoded, headers=_HDR_FORM)
+        if response.status >= 400:
+            print(f"Error en la solicitud HTTP: {response.status} - {response.reason}")
+            return ""
+        # Convertir la respuesta de JSON a un diccionario de Python
+        respuesta_json = _loads(response.data)
+        return respuesta_json.get("id", "")
     except HTTPError as e:
-        print(f"Error en la solicitud HTTP: {e.code} - {e.reason}")
-        return ""
-    except URLError as e:
-        print(f"Error en la URL: {e.reason}")
+        print(f"Error en la URL: {e}")
         return ""
     except json.JSONDecodeError:
         print("Error al decodificar la respuesta JSON")
         return ""
 
+def _cotizar_y_generar_pdf(datos):
+    """
+    Cotiza y genera el PDF de la cotización, para ejecutarlo en segundo plano.
+    
+    Args:
+        datos (dict): Datos del cliente para cotizar
+        
+    Returns:
+        str: ID de la cotización generada
+    """
+    id_cotizacion = cotizar(datos)
+    generar_pdf(id_cotizacion)
+    return id_cotizacion
+
 def agregar_beneficiario(datos):
     """
     Agrega un beneficiario a una cotización.
@@ -371,21 +714,17 @@ def agregar_beneficiario(datos):
         str: ID del beneficiario agregado
     """
     url = "https://YOUR_QUOTE_SERVICE.co/app/chatbot/bchatbot.php"
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
     data_encoded = urlencode(datos).encode('utf-8')
-    
-    req = Request(url, data=data_encoded, headers=headers)
 
     try:
-        with urlopen(req) as response:
-            response_text = response.read().decode('utf-8')
-            respuesta_json = json.loads(response_text)
-            return respuesta_json.get("id", "")
+        response = HTTP.request('POST', url, body=data_encoded, headers=_HDR_FORM)
+        if response.status >= 400:
+            print(f"Error en la solicitud HTTP: {response.status} - {response.reason}")
+            return ""
+        respuesta_json = _loads(response.data)
+        return respuesta_json.get("id", "")
     except HTTPError as e:
-        print(f"Error en la solicitud HTTP: {e.code} - {e.reason}")
-        return ""
-    except URLError as e:
-        print(f"Error en la URL: {e.reason}")
+        print(f"Error en la URL: {e}")
         return ""
     except json.JSONDecodeError:
         print("Error al decodificar la respuesta JSON")
@@ -402,21 +741,17 @@ def asignar_a_analista(datos):
         str: ID de la asignación
     """
     url = "https://YOUR_QUOTE_SERVICE.co/app/chatbot/asignar.php"
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
     data_encoded = urlencode(datos).encode('utf-8')
-    
-    req = Request(url, data=data_encoded, headers=headers)
 
     try:
-        with urlopen(req) as response:
-            response_text = response.read().decode('utf-8')
-            respuesta_json = json.loads(response_text)
-            return respuesta_json.get("id", "")
+        response = HTTP.request('POST', url, body=data_encoded, headers=_HDR_FORM)
+        if response.status >= 400:
+            print(f"Error en la solicitud HTTP: {response.status} - {response.reason}")
+            return ""
+        respuesta_json = _loads(response.data)
+        return respuesta_json.get("id", "")
     except HTTPError as e:
-        print(f"Error en la solicitud HTTP: {e.code} - {e.reason}")
-        return ""
-    except URLError as e:
-        print(f"Error en la URL: {e.reason}")
+        print(f"Error en la URL: {e}")
         return ""
     except json.JSONDecodeError:
         print("Error al decodificar la respuesta JSON")
@@ -428,29 +763,45 @@ def dump_data(data):
     print(data_str)
     print("******************")
 
-def parentesco_valido(cadena):
-    parentescos = {"Madre", "Padre", "Esposo", "Esposa", "Hijo", "Hija", "Hermano", "Hermana"}
-    parentescos = {palabra.lower() for palabra in parentescos}
-
-    return cadena.strip().lower() in parentescos
+# Segundos que se reutiliza el listado de una carpeta en el contenedor (0 desactiva la caché).
+_DOCUMENTOS_TTL = int(os.environ.get('DOCUMENTOS_CACHE_TTL', '300'))
 
-def obtener_documentos(folder_path):
+@functools.lru_cache(maxsize=512)
+def _listar_documentos(folder_path, periodo):
+    """
+    Consulta el servicio de documentos. Los errores se propagan para que no
+    queden guardados en la caché.
+    
+    Args:
+        folder_path (str): Carpeta relativa al servicio de documentos
+        periodo (int): Ventana de TTL; al cambiar invalida la entrada en caché
+        
+    Returns:
+        tuple: Nombres de los archivos y carpetas, compartido, no debe modificarse
+    """
     url = "https://YOUR_DOCUMENT_SERVICE.co/doc_asist/getfiles.php"
-    params = {'folder': folder_path}
-    query_string = urlencode(params)
-    url_with_params = f"{url}?{query_string}"
+    response = HTTP.request('GET', url, fields={'folder': folder_path})
+    if response.status >= 400:
+        raise HTTPError(f"{response.status} - {response.reason}")
+    return tuple(_loads(response.data))
 
+def obtener_documentos(folder_path):
+    """
+    Lista los documentos de una carpeta, reutilizando el resultado durante
+    DOCUMENTOS_CACHE_TTL segundos.
+    
+    Args:
+        folder_path (str): Carpeta relativa al servicio de documentos
+        
+    Returns:
+        tuple: Nombres de los documentos o None si hubo error
+    """
     try:
-        req = Request(url_with_params)
-        with urlopen(req) as response:
-            data = response.read()
-            documentos = json.loads(data)
-            return documentos
+        if _DOCUMENTOS_TTL > 0:
+            return _listar_documentos(folder_path, int(time.time() // _DOCUMENTOS_TTL))
+        return _listar_documentos.__wrapped__(folder_path, 0)
     except HTTPError as e:
-        print(f"HTTP Error: {e.code} - {e.reason}")
-        return None
-    except URLError as e:
-        print(f"URL Error: {e.reason}")
+        print(f"HTTP Error: {e}")
         return None
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -458,31 +809,754 @@ def obtener_documentos(folder_path):
 
 
 def agregar_opciones(historial, opciones, paso_default):
-    if not isinstance(paso_default, dict):
-        paso_default = {opcion.lower(): paso_default for opcion in opciones}
-
-    historial_actualizado = historial if historial else {}
-
-    for opcion in opciones:
-        opcion_min = opcion.lower()  # Convertir la opción a minúsculas
-        historial_actualizado[opcion_min] = paso_default.get(opcion_min, "start") 
+    """
+    Registra en el historial el paso al que lleva cada opción del menú.
+    Modifica el historial recibido en lugar de copiarlo.
     
-    return historial_actualizado
+    Args:
+        historial (dict): Historial del usuario (opción en minúsculas -> paso)
+        opciones (iterable): Opciones mostradas al usuario
+        paso_default (str or dict): Paso común, o paso por opción ("start" si falta)
+        
+    Returns:
+        dict: El mismo historial, actualizado
+    """
+    if isinstance(paso_default, dict):
+        for opcion in opciones:
+            opcion_min = opcion.lower()  # Convertir la opción a minúsculas
+            historial[opcion_min] = paso_default.get(opcion_min, "start")
+    else:
+        historial.update((opcion.lower(), paso_default) for opcion in opciones)
+    return historial
 
 
 def dividir_mensaje(mensaje, max_length=1000):
     trozos = []
-    while len(mensaje) > max_length:
-        corte = mensaje.rfind(' ', 0, max_length)
+    # Se mide sin el espacio final para no dejar un último trozo vacío.
+    inicio, n = 0, len(mensaje.rstrip())
+    while n - inicio > max_length:
+        limite = inicio + max_length
+        corte = mensaje.rfind(' ', inicio, limite)
         if corte == -1:
-            corte = mensaje.rfind('.', 0, max_length) + 1
-        if corte == -1:
-            corte = max_length
-        trozos.append(mensaje[:corte].strip())
-        mensaje = mensaje[corte:].strip()
-    trozos.append(mensaje)
+            corte = mensaje.rfind('.', inicio, limite)
+            corte = corte + 1 if corte != -1 else limite
+        trozo = mensaje[inicio:corte].strip()
+        if trozo:
+            trozos.append(trozo)
+        inicio = corte
+        while inicio < n and mensaje[inicio].isspace():
+            inicio += 1
+    trozo = mensaje[inicio:n].strip()
+    if trozo:
+        trozos.append(trozo)
     return trozos
 
+def _botones_por_rol(rol):
+    """
+    Elige los botones de cierre según el rol del usuario.
+    
+    Args:
+        rol (str): Rol del usuario
+        
+    Returns:
+        MappingProxyType: Botones compartidos, no deben modificarse
+    """
+    return _BOTONES_SI_NO_VOLVER if rol in _ROLES_ADMIN else _BOTONES_SI_NO_COTIZAR
+
+@dataclass
+class Contexto:
+    """
+    Estado de un mensaje entrante que comparten los manejadores de cada paso.
+    """
+    sender: str
+    usuario: dict
+    mensaje_decoded: str
+    nombre: str
+    rol: str
+    developer: str
+    texto: str = ''
+    botones: dict = field(default_factory=dict)
+    opciones: dict = field(default_factory=dict)
+    url_pdf: str = None
+    pdf_file: str = None
+    model: str = _MODELO_DEFAULT
+
+# Manejadores de la conversación indexados por el paso ('step') del usuario.
+STEP_HANDLERS = {}
+
+def registrar_paso(step):
+    """
+    Decorador que registra un manejador de paso en STEP_HANDLERS.
+    
+    Args:
+        step (str): Nombre del paso
+    """
+    def decorador(manejador):
+        STEP_HANDLERS[step] = manejador
+        return manejador
+    return decorador
+
+def _h_start(ctx):
+    """
+    Saludo inicial según el rol del usuario.
+    """
+    usuario = ctx.usuario
+    sender = ctx.sender
+    nombre = ctx.nombre
+    rol = ctx.rol
+    usuario['poliza'] = 'Salud'
+    usuario['cotiza'] = ""
+    if nombre == "":
+        ctx.texto = 'Hola, espero te encuentres bien. Soy *TUBOT*, ejecutivo virtual de *TUEMPRESA*. Es un gusto para mí atenderte para ofrecerte diferentes opciones de seguros de salud.\n\n¿Sería tan amable de darme su nombre y apellido?'
+        usuario['step'] = 'askedWelcome'
+    else:
+        if rol == "admin":
+            ctx.texto = f'Hola *{nombre}*, espero te encuentres bien. Soy *TUBOT*, ejecutivo virtual de *TUEMPRESA*.'
+            enviar_mensaje_telegram(sender, ctx.texto, ctx.botones, ctx.url_pdf, ctx.pdf_file, ctx.opciones)
+            ctx.texto = f'¿En qué área te puedo ayudar?'
+            ctx.opciones = _OPCIONES_AREAS
+            agregar_opciones(usuario['historial'], ctx.opciones, 'askedAdmin')
+            enviar_mensaje_telegram(sender, ctx.texto, None, None, None, ctx.opciones)
+            ctx.texto = ''
+            usuario['step'] = 'askedAdmin'
+        elif rol == "developer":
+            ctx.texto = f'Hola *{nombre}*, soy *TUBOTSECUNDARIO*, pregúntame lo que quieras'
+            usuario['step'] = 'waitForQuestion'
+            usuario['modo'] = 'gandalf'
+        else:
+            ctx.texto = f'Hola *{nombre}*, espero te encuentres bien. Soy *TUBOT*, ejecutivo virtual de *TUEMPRESA*. Es un gusto para mí atenderte para ofrecerte diferentes opciones de seguros de salud.\n\n¿Sería tan amable de indicarme su fecha de nacimiento?'
+            usuario['step'] = 'askedBirthdate'
+
+@registrar_paso('master')
+def _h_master(ctx):
+    usuario = ctx.usuario
+    sender = ctx.sender
+    nombre = ctx.nombre
+    developer = ctx.developer
+    usuario['poliza'] = 'Salud'
+    usuario['cotiza'] = ""
+    ctx.texto = f'Hola *{nombre}*, espero te encuentres bien. Soy *TUBOT*, ejecutivo virtual de *TUEMPRESA*.'
+    enviar_mensaje_telegram(sender, ctx.texto, ctx.botones, ctx.url_pdf, ctx.pdf_file, ctx.opciones)
+    ctx.texto = f'¿Con que rol quieres interactuar conmigo?'
+    if developer=="ON":
+        ctx.opciones = _OPCIONES_ROLES_DEV
+    else:
+        ctx.opciones = _OPCIONES_ROLES
+    agregar_opciones(usuario['historial'], ctx.opciones, 'askedMaster')
+    enviar_mensaje_telegram(sender, ctx.texto, None, None, None, ctx.opciones)
+    ctx.texto = ''
+    usuario['step'] = 'askedMaster'
+
+def _h_chatgpt(ctx):
+    """
+    Activa el modo de preguntas libres.
+    """
+    usuario = ctx.usuario
+    ctx.texto = 'Estoy aqui para responder tus preguntas. Adelante.'
+    usuario['step'] = 'waitForQuestion'
+
+@registrar_paso('askedWelcome')
+def _h_asked_welcome(ctx):
+    usuario = ctx.usuario
+    mensaje_decoded = ctx.mensaje_decoded
+    if usuario['modo'] != 'normal':
+        return _h_desconocido(ctx)
+    usuario['nombre'] = _normalizar_nombre(mensaje_decoded)
+    nombre=usuario['nombre']
+    ctx.texto = f'Un gusto *{nombre}*. También indícame tu fecha de nacimiento:'
+    usuario['step'] = 'askedBirthdate'
+
+@registrar_paso('askedBirthdate')
+def _h_asked_birthdate(ctx):
+    usuario = ctx.usuario
+    mensaje_decoded = ctx.mensaje_decoded
+    fecha=validar_fecha(mensaje_decoded)
+    if fecha:
+        usuario['fecha'] = mensaje_decoded
+        ctx.texto = 'Y ahora tu correo electrónico.'
+        usuario['step'] = 'askedEmail'
+    else:
+        ctx.texto = 'La fecha no es correcta, por favor ingresa una fecha valida (DD/MM/AAAA).'
+        usuario['step'] = 'askedBirthdate'
+
+@registrar_paso('askedOnlyName')
+def _h_asked_only_name(ctx):
+    usuario = ctx.usuario
+    sender = ctx.sender
+    mensaje_decoded = ctx.mensaje_decoded
+    usuario['nombre'] = _normalizar_nombre(mensaje_decoded)
+    usuario['step'] = 'end'
+    nombre=usuario['nombre']
+    poliza=usuario['poliza']
+    data = {
+        'telefono': sender,
+        'nombre': usuario['nombre'],
+        'poliza': usuario['poliza']
+    }
+    asignar_a_analista(data)
+    ctx.texto = f'Gracias {nombre}, voy a dirigir tu llamada a un analista para una póliza de {poliza}. ¿Tienes alguna otra pregunta para mí?'
+    ctx.botones = _BOTONES_SI_NO_COTIZAR
+    usuario['step'] = 'additionalHelp'
+
+@registrar_paso('askedName')
+def _h_asked_name(ctx):
+    usuario = ctx.usuario
+    mensaje_decoded = ctx.mensaje_decoded
+    usuario['nombre'] = _normalizar_nombre(mensaje_decoded)
+    ctx.texto = 'Proporciona un correo electrónico para contactarte'     
+    usuario['step'] = 'askedEmail'
+
+@registrar_paso('askedEmail')
+def _h_asked_email(ctx):
+    usuario = ctx.usuario
+    mensaje_decoded = ctx.mensaje_decoded
+    if correo_es_valido(mensaje_decoded):
+        usuario['email'] = mensaje_decoded
+        ctx.texto = 'Por último, selecciona tu género:'
+        ctx.botones = _BOTONES_GENERO
+        usuario['step'] = 'askedSex'
+    else:
+        ctx.texto = 'El correo electrónico ingresado no es válido. Por favor, ingresa un correo electrónico válido.'
+
+@registrar_paso('askedSex')
+def _h_asked_sex(ctx):
+    usuario = ctx.usuario
+    mensaje_decoded = ctx.mensaje_decoded
+    usuario['sexo'] = mensaje_decoded
+    usuario['bcuenta']=0
+    usuario['beneficiario'] = "no"
+    ctx.texto = f'¿Desea agregar a un familiar a la cotización?'
+    ctx.botones = _BOTONES_SI_NO
+    usuario['step'] = 'askBenefit'
+
+@registrar_paso('askBenefit')
+def _h_ask_benefit(ctx):
+    usuario = ctx.usuario
+    mensaje_decoded = ctx.mensaje_decoded
+    if mensaje_decoded == 'si':
+        usuario['beneficiario'] = "si"
+        ctx.texto = 'Escribe el parentesco (Madre, Padre, Esposo, Esposa, Hijo, Hija, Hermano o Hermana):'
+        usuario['step'] = 'askedParent'
+    else:
+        ctx.texto = 'Ha elegido no agregar más familiares. Procederé a preparar su cotización.'
+        ctx.botones = _BOTONES_CONTINUAR
+        usuario['step'] = 'askedFamily'
+
+@registrar_paso('askedParent')
+def _h_asked_parent(ctx):
+    usuario = ctx.usuario
+    mensaje_decoded = ctx.mensaje_decoded
+    parentesco = mensaje_decoded.strip()
+    if parentesco in _PARENTESCOS:
+        usuario['parentesco'] = parentesco
+        ctx.texto = f'Escribe la fecha de nacimiento de tu {parentesco}:'
+        usuario['step'] = 'askedBirthdateParent'
+    else:
+        ctx.texto = f'El parentesco no es correcto. Por favor, escribe alguna de estas opciones: Madre, Padre, Esposo, Esposa, Hijo, Hija, Hermano o Hermana'
+
+@registrar_paso('askedBirthdateParent')
+def _h_asked_birthdate_parent(ctx):
+    usuario = ctx.usuario
+    sender = ctx.sender
+    mensaje_decoded = ctx.mensaje_decoded
+    fecha=validar_fecha(mensaje_decoded)
+    if fecha:
+        usuario['bfecha'] = mensaje_decoded
+        usuario['bcuenta']=usuario['bcuenta']+1
+        data = {
+            'btoken': sender,
+            'bfecha': fecha_sql(usuario['bfecha']),
+            'bparentesco': usuario['parentesco'],
+            'correlativo': usuario['bcuenta']
+        }
+        agregar_beneficiario(data)
+        ctx.texto = f'¿Desea agregar a otro familiar a la cotización?'
+        ctx.botones = _BOTONES_SI_NO
+        usuario['step'] = 'askBenefit'
+    else:
+        ctx.texto = 'La fecha no es correcta, por favor ingresa una fecha valida (DD/MM/AAAA).'
+
+@registrar_paso('askedFamily')
+def _h_asked_family(ctx):
+    usuario = ctx.usuario
+    sender = ctx.sender
+    usuario['bcuenta']=0
+    ctx.texto = 'Perfecto, en este momento le estoy enviando un cuadro de cotización para que proceda con su revisión.'
+    aviso = _enviar_async(sender, ctx.texto, ctx.botones, ctx.url_pdf, ctx.pdf_file, ctx.opciones)
+    # Datos del cliente que no cambian entre las dos cotizaciones.
+    nombre=usuario['nombre']
+    fecha=fecha_sql(usuario['fecha'])
+    email=usuario['email']
+    sexo=usuario['sexo']
+    usuario['plan']="Amplio"
+    usuario['monto']="100000"
+    usuario['monto2']="200000"
+    usuario['modo'] = "chatgpt"
+    usuario['step'] = "waitForQuestion"
+    guardar_usuario(sender, usuario)
+    data = {
+        'telefono': sender,
+        'fecha': fecha,
+        'nombre': nombre,
+        'email': email,
+        'sexo': sexo,
+        'plan': usuario['plan'],
+        'monto': usuario['monto'],
+        'monto2': usuario['monto2']
+    }            
+    id_cotizacion=cotizar(data)
+    print("Generando PDF ", id_cotizacion)
+    generar_pdf(id_cotizacion)
+
+    usuario['monto']= "50000"
+    usuario['monto2']="30000"
+    usuario['monto3']="20000"
+    usuario['plan']="Amplio"
+
+    data = {
+        'telefono': sender,
+        'fecha': fecha,
+        'nombre': nombre,
+        'email': email,
+        'sexo': sexo,
+        'plan': usuario['plan'],
+        'monto': usuario['monto'],
+        'monto2': usuario['monto2'],
+        'monto3': usuario['monto3'],
+        'bdelete': "SI"
+    }            
+    # La segunda cotización borra los beneficiarios (bdelete), que se guardan por
+    # btoken y no por cotización: sólo arranca cuando el PDF de la primera ya
+    # está generado con los familiares, y se solapa con el envío a Telegram.
+    segunda = _EXEC.submit(_cotizar_y_generar_pdf, data)
+    aviso.result()
+    if id_cotizacion:
+        print("PDF generado con exito ", id_cotizacion)
+        usuario['cotiza']=str(id_cotizacion)
+        ctx.url_pdf = f"https://YOUR_PDF_SERVICE.co/pdfgen/{id_cotizacion}.pdf"
+        ctx.pdf_file=f"Cotizacion_{id_cotizacion}.pdf"
+        ctx.texto = f"Tu cotización {id_cotizacion} ya está lista. Puedes verla aquí."
+        #if sender not in polizas:
+        #    polizas[sender] = {'telefono': sender,'nombre': nombre, 'poliza': "Salud"}                   
+    else:
+        ctx.texto = "Hubo un error al procesar tu cotización."
+        ctx.url_pdf=None
+    pendientes = [(ctx.texto, ctx.botones, ctx.url_pdf, ctx.pdf_file, ctx.opciones)]
+
+    ctx.texto = "Por otro lado, le estoy enviando otras cotizaciones que puedan adaptarse a su presupuesto"
+    ctx.url_pdf=None
+    pendientes.append((ctx.texto, ctx.botones, ctx.url_pdf, ctx.pdf_file, ctx.opciones))
+    # El resultado y el aviso salen en orden mientras termina la segunda cotización.
+    aviso = _enviar_lote_async(sender, pendientes)
+
+    id_cotizacion = segunda.result()
+    aviso.result()
+    if id_cotizacion:
+        ctx.url_pdf = f"https://YOUR_PDF_SERVICE.co/pdfgen/{id_cotizacion}.pdf"
+        ctx.pdf_file=f"Cotizacion_{id_cotizacion}.pdf"
+        ctx.texto = f"Tu cotización {id_cotizacion} ya está lista. Puedes verla aquí."
+        #if sender not in polizas:
+        #    polizas[sender] = {'telefono': sender,'nombre': nombre, 'poliza': "Salud"}                   
+    else:
+        ctx.texto = "Hubo un error al procesar tu cotización."
+        ctx.url_pdf=None
+    pendientes = [(ctx.texto, ctx.botones, ctx.url_pdf, ctx.pdf_file, ctx.opciones)]
+
+    poliza=usuario['poliza']
+    data = {
+        'telefono': sender,
+        'nombre': nombre,
+        'poliza': f"Salud #{id_cotizacion}"
+    }
+    # asignar_a_analista(data)
+    ctx.url_pdf=None
+    ctx.texto = 'Tu cotización ha sido procesada con éxito. ¿Tienes alguna otra pregunta para mí?'
+    pendientes.append((ctx.texto, ctx.botones, ctx.url_pdf, ctx.pdf_file, ctx.opciones))
+    enviar_mensajes_telegram(sender, pendientes)
+    ctx.texto = ''
+    usuario['modo'] = "chatgpt"
+    usuario['step'] = "waitForQuestion"
+    guardar_usuario(sender, usuario)
+
+@registrar_paso('end')
+def _h_end(ctx):
+    usuario = ctx.usuario
+    rol = ctx.rol
+    ctx.texto = '¿Tienes alguna otra pregunta para mí?'
+    if usuario['poliza'] == 'Salud':
+        ctx.texto = 'Tu cotización ha sido procesada con éxito. ¿Tienes alguna otra pregunta para mí?'
+    ctx.botones = _botones_por_rol(rol)
+    usuario['step'] = 'additionalHelp'
+
+@registrar_paso('additionalHelp')
+def _h_additional_help(ctx):
+    usuario = ctx.usuario
+    mensaje_decoded = ctx.mensaje_decoded
+    rol = ctx.rol
+    if mensaje_decoded in _NEGATIVE:
+        if rol in _ROLES_ADMIN:
+            ctx.texto = '¡Gracias por contactarme! Si necesitas más ayuda en el futuro, no dudes en escribirme.'
+        else:
+            ctx.texto = '¡Gracias por contactarnos! Si necesitas más ayuda en el futuro, no dudes en escribirnos.'
+        usuario['step'] = 'finalizado'
+        usuario['modo'] = 'normal'
+    elif mensaje_decoded in _VOLVER_TOKENS or mensaje_decoded.startswith('hola'):
+        if rol in _ROLES_ADMIN:
+            ctx.texto = '¡Seguro! Solo escribeme *Hola* otra vez cuando quieras volver a consultar..'
+        else:
+            ctx.texto = '¡Seguro! Solo escribeme *Hola* otra vez cuando quieras volver a cotizar..'
+        usuario['step'] = 'start'
+        usuario['modo'] = 'normal'
+    elif mensaje_decoded in _AFFIRMATIVE:
+        if usuario['modo'] == 'gandalf':
+            ctx.texto = 'Pregúntame lo que quieras. Soy *Gandalf el Blanco*.'
+        else:
+            ctx.texto = 'Por favor, escribe tu pregunta a continuación.'
+            usuario['modo'] = 'chatgpt'
+        usuario['step'] = 'waitForQuestion'
+    else:
+        if usuario['modo'] == 'chatgpt':
+            respuesta_chatgpt = pregunta_a_chatgpt(mensaje_decoded)
+            if respuesta_chatgpt == "TOKEN_START":
+                ctx.texto = "¡Bien! Vamos a cotizar de nuevo..."
+                usuario['step'] = 'start'
+                usuario['modo'] = 'normal'
+            elif respuesta_chatgpt == "TOKEN_END":
+                ctx.texto = '¡Gracias por contactarnos! Si necesitas más ayuda en el futuro, no dudes en escribirnos.'
+                usuario['step'] = 'finalizado'
+                usuario['modo'] = 'normal'
+            else:
+                ctx.texto = respuesta_chatgpt + "\n\n¿Tienes otra pregunta?"
+                ctx.botones = _botones_por_rol(rol)
+                usuario['step'] = 'confirmContinue'
+        else:
+            pass
+
+@registrar_paso('endCotiza')
+def _h_end_cotiza(ctx):
+    usuario = ctx.usuario
+    rol = ctx.rol
+    ctx.texto = respuesta_chatgpt + "\n\n¿Tienes otra pregunta?"
+    ctx.botones = _botones_por_rol(rol)
+    usuario['step'] = 'confirmContinue'
+
+@registrar_paso('waitForQuestion')
+def _h_wait_for_question(ctx):
+    usuario = ctx.usuario
+    sender = ctx.sender
+    mensaje_decoded = ctx.mensaje_decoded
+    rol = ctx.rol
+    model = ctx.model
+    if not (mensaje_decoded == "continuar"):
+        if usuario['modo'] == 'gandalf' or rol == "developer":
+            respuesta_chatgpt = pregunta_a_gandalf(mensaje_decoded, model)
+        else:
+            respuesta_chatgpt = pregunta_a_chatgpt(mensaje_decoded, model)
+        # Los trozos salen en orden por la conexión keep-alive; no hace falta pausa entre ellos.
+        enviar_mensajes_telegram(sender, [(trozo, None, None, None, None) for trozo in dividir_mensaje(respuesta_chatgpt)])
+        ctx.texto = "¿Tienes otra pregunta?"
+        ctx.botones = _botones_por_rol(rol)
+        usuario['step'] = 'additionalHelp'
+
+@registrar_paso('confirmContinue')
+def _h_confirm_continue(ctx):
+    usuario = ctx.usuario
+    mensaje_decoded = ctx.mensaje_decoded
+    if mensaje_decoded in _AFFIRMATIVE:
+        ctx.texto = '¡Muy bien! Haz tu próxima pregunta.'
+        usuario['step'] = 'additionalHelp'
+        usuario['modo'] = 'chatgpt'
+    elif mensaje_decoded == 'cotiza':
+        ctx.texto = '¡Seguro! Podemos volver a cotizar.'
+        usuario['step'] = 'start'
+        usuario['modo'] = 'normal'
+    else:
+        ctx.texto = '¡Gracias por contactarnos! Si necesitas más ayuda en el futuro, no dudes en escribirnos.'
+        usuario['step'] = 'finalizado'
+        usuario['modo'] = 'normal'
+
+@registrar_paso('askedAdmin')
+def _h_asked_admin(ctx):
+    usuario = ctx.usuario
+    sender = ctx.sender
+    mensaje_decoded = ctx.mensaje_decoded
+    ctx.texto = '¿En qué subárea te puedo ayudar?'
+    usuario['step'] = 'start'
+    usuario['modo'] = 'normal'
+    if mensaje_decoded in _CATEGORIAS:
+        usuario['categoria'] = mensaje_decoded
+        ctx.opciones = _SUBOPCIONES[mensaje_decoded]
+        agregar_opciones(usuario['historial'], ctx.opciones, 'sub_category_selection')
+        usuario['opciones'] = list(ctx.opciones)
+        ctx.texto = "Selecciona una subcategoría:"
+        usuario['step'] = 'sub_category_selection'
+    if mensaje_decoded == 'hablar con deyna':
+        ctx.texto = 'Estoy aqui para responder tus preguntas. Adelante.'
+        ctx.opciones = {}
+        enviar_mensaje_telegram(sender, ctx.texto, ctx.botones, ctx.url_pdf, ctx.pdf_file, ctx.opciones)
+        usuario['step'] = 'waitForQuestion'
+        usuario['modo'] = 'chatgpt'
+        ctx.texto = ''
+
+@registrar_paso('askedMaster')
+def _h_asked_master(ctx):
+    usuario = ctx.usuario
+    sender = ctx.sender
+    mensaje_decoded = ctx.mensaje_decoded
+    nombre = ctx.nombre
+    developer = ctx.developer
+    if mensaje_decoded=="usuario":
+        ctx.texto = 'Hola, espero te encuentres bien. Soy *TUBOT*, ejecutivo virtual de *TUEMPRESA*. Es un gusto para mí atenderte para ofrecerte diferentes opciones de seguros de salud.\n\n¿Sería tan amable de darme su nombre y apellido?'
+        usuario['rol'] = 'user'
+        usuario['modo'] = 'normal'
+        usuario['step'] = 'askedWelcome'
+    if mensaje_decoded=="asociado":
+        ctx.texto = f'¿En qué área te puedo ayudar?'
+        ctx.opciones = _OPCIONES_AREAS
+        agregar_opciones(usuario['historial'], ctx.opciones, 'askedAdmin')
+        enviar_mensaje_telegram(sender, ctx.texto, None, None, None, ctx.opciones)
+        ctx.texto = ''
+        usuario['rol'] = 'admin'
+        usuario['step'] = 'askedAdmin'
+        usuario['modo'] = 'normal'
+    if mensaje_decoded=="desarrollador" and developer=="ON":
+        ctx.texto = f'Hola *{nombre}*, soy *TUBOTSECUNDARIO*, pregúntame lo que quieras'
+        usuario['rol'] = 'developer'
+        usuario['step'] = 'waitForQuestion'
+        usuario['modo'] = 'gandalf'
+    if mensaje_decoded=="master":
+        ctx.texto = '¡Hola Maestro! ¿Que nueva instrucción o sugerencia quieres que aprenda?'
+        usuario['step'] = 'askedTrainer'
+
+@registrar_paso('askedTrainer')
+def _h_asked_trainer(ctx):
+    usuario = ctx.usuario
+    sender = ctx.sender
+    mensaje_decoded = ctx.mensaje_decoded
+    ctx.texto = 'Memorizando. Espera un momento por favor...'
+    aviso = _enviar_async(sender, ctx.texto, None, None, None, None)
+    user_data = recuperar_usuario("deyna", projection=('instrucciones',))
+    if user_data and 'instrucciones' in user_data:
+        instrucciones = user_data['instrucciones']+"\n"+mensaje_decoded
+        _actualizar_usuario("deyna", {'instrucciones': instrucciones})
+        time.sleep(1)
+        response = pregunta_a_chatgpt("TUBOT:reborn")
+        ctx.texto = 'Mi base de conocimiento ha sido actualizada con éxito.'
+        usuario['step'] = 'master'
+    else:
+        ctx.texto = 'Mi base de conocimiento no tiene instrucciones. Algo anda mal con mi servidor.'
+        usuario['step'] = 'master'
+    aviso.result()
+
+@registrar_paso('gandalf')
+def _h_gandalf(ctx):
+    usuario = ctx.usuario
+    sender = ctx.sender
+    ctx.texto = 'Estoy aqui para responder tus preguntas. Adelante.'
+    ctx.opciones = {}
+    enviar_mensaje_telegram(sender, ctx.texto, ctx.botones, ctx.url_pdf, ctx.pdf_file, ctx.opciones)
+    usuario['step'] = 'waitForQuestion'
+    usuario['modo'] = 'gandalf'
+    ctx.texto = ''
+
+@registrar_paso('sub_category_selection')
+def _h_sub_category_selection(ctx):
+    usuario = ctx.usuario
+    mensaje_decoded = ctx.mensaje_decoded
+    if usuario['categoria'] in _CATEGORIAS:
+        usuario['subcategoria'] = mensaje_decoded
+        if mensaje_decoded in _SUBCATEGORIAS_COMPANIA:
+            usuario['step'] = 'company_selection'
+            usuario['companies'] = list(_COMPANIAS_POR_SUBCATEGORIA.get(mensaje_decoded, ()))
+            ctx.opciones = usuario['companies']
+            agregar_opciones(usuario['historial'], ctx.opciones, 'company_selection')
+            ctx.texto = "Selecciona una aseguradora:"
+        else:
+            print ("ELEGIR: ",usuario['categoria'], ",", mensaje_decoded, ",", usuario['subcategoria'])
+            documento, tipo, base_path = elegir_documento(usuario['categoria'], mensaje_decoded)
+            usuario['base_path'] = base_path
+            if tipo == 'list':
+                usuario['documents'] = documento                        
+                print("1:",base_path,"2:",documento)                        
+                ctx.opciones = documento
+                agregar_opciones(usuario['historial'], ctx.opciones, 'document_choice')
+                ctx.texto = "Selecciona un archivo o carpeta:" 
+                usuario['step'] = 'document_choice'
+            elif tipo == 'single':
+                ctx.url_pdf = documento
+                if 'base_path' in usuario and usuario['base_path'] is not None:
+                    ctx.url_pdf=usuario['base_path']+ctx.url_pdf
+                ctx.pdf_file = f"{mensaje_decoded[:22]}.pdf"
+                ctx.texto = f"Aquí está el documento que solicitaste"
+                usuario['step'] = 'start'                    
+            else:
+                ctx.texto = "Opción no válida. Selecciona una opción válida."
+    else:
+        ctx.texto = "Subcategoría no reconocida. Elige una opción válida."
+
+@registrar_paso('company_selection')
+def _h_company_selection(ctx):
+    usuario = ctx.usuario
+    mensaje_decoded = ctx.mensaje_decoded
+    documento, tipo, base_path = elegir_documento(usuario['categoria'], usuario['subcategoria'], mensaje_decoded)
+    usuario['base_path'] = base_path
+    if tipo == 'list':
+        usuario['documents'] = documento
+        print("1:",base_path,"2:",documento)
+        usuario['base_path'] = base_path
+        ctx.opciones = documento
+        agregar_opciones(usuario['historial'], ctx.opciones, 'document_choice')
+        ctx.texto = "Selecciona un archivo o carpeta:" 
+        usuario['step'] = 'document_choice'
+    elif tipo == 'single':
+        ctx.url_pdf = documento
+        if 'base_path' in usuario and usuario['base_path'] is not None:
+            ctx.url_pdf=usuario['base_path']+ctx.url_pdf
+        ctx.pdf_file = f"{mensaje_decoded}.pdf"
+        ctx.texto = f"Aquí está el documento que solicitaste"
+        usuario['step'] = 'start'                    
+    else:
+        ctx.texto = "Opción no válida. Selecciona una opción válida."
+
+def _expandir_carpeta(base_path, carpeta):
+    """
+    Lista una subcarpeta del servicio de documentos y arma la URL de cada entrada.
+    
+    Args:
+        base_path (str): URL de la carpeta actual
+        carpeta (str): Nombre de la subcarpeta elegida
+        
+    Returns:
+        dict: Nombre -> URL de cada documento, o None si la carpeta está vacía o falló
+    """
+    folder_path = base_path.rstrip('/') + '/' + carpeta.lstrip('/')
+    print("obtener_documentos(",folder_path,")")
+    documentos = obtener_documentos(folder_path.replace("https://YOUR_DOCUMENT_SERVICE.co/doc_asist/", ""))
+    if not documentos:
+        return None
+    if not folder_path.endswith("/"):
+        folder_path=folder_path+"/"
+    return {doc: f"{folder_path}{doc}" for doc in documentos}
+
+@registrar_paso('document_choice')
+def _h_document_choice(ctx):
+    usuario = ctx.usuario
+    mensaje_decoded = ctx.mensaje_decoded
+    selected_doc = usuario['documents'].get(mensaje_decoded, None)
+    if selected_doc:
+        print("Documento seleccionado: ",selected_doc)
+    if selected_doc and selected_doc.endswith("pdf"):
+        print("Termina en PDF")
+        ctx.url_pdf = selected_doc
+        ctx.pdf_file = f"{mensaje_decoded}"
+        ctx.texto = f"Aquí está el documento que solicitaste"
+        ctx.botones = {}
+        ctx.opciones = {}
+        usuario['step'] = 'start'
+    else:
+        # Carpeta elegida del menú o escrita a mano: se lista en ambos casos.
+        documentos_urls = _expandir_carpeta(usuario['base_path'], mensaje_decoded)
+        if documentos_urls:
+            usuario['documents'] = documentos_urls
+            ctx.opciones = documentos_urls
+            agregar_opciones(usuario['historial'], ctx.opciones, 'document_choice')
+            ctx.texto = "Selecciona un archivo o carpeta:" 
+            usuario['step'] = 'document_choice'
+        else:
+            ctx.texto = "Documento no válido o carpeta vacia. Intente de nuevo."
+            usuario['step'] = 'start'
+
+def _h_desconocido(ctx):
+    """
+    Mensaje no reconocido: reinicia la conversación.
+    """
+    usuario = ctx.usuario
+    ctx.texto = 'No entiendo tu mensaje. Escribe *hola* para empezar de nuevo.'
+    usuario['step'] = 'start'
+    usuario['modo'] = 'normal'
+
+def _respuesta_usuario(user_id, usuario):
+    """
+    Construye la respuesta HTTP con los datos del usuario ya en memoria.
+    """
+    user_data = {'userID': user_id, **usuario}
+    print(user_data)
+    return {
+        'statusCode': 200,
+        'body': json.dumps(user_data, indent=4, default=str)
+    }
+
+def _get_usuario(user_id, params):
+    user_data = recuperar_usuario(user_id)
+    if user_data:
+        if 'bcuenta' in user_data:
+            del user_data['bcuenta']
+        return _respuesta_usuario(user_id, user_data)
+
+def _reiniciar_usuario(user_id, rol):
+    keys_to_delete = ['bcuenta', 'documents', 'companies', 'opciones', 'base_path']
+    usuario = _actualizar_usuario(user_id, {
+        'step': 'start',
+        'rol': rol,
+        'historial': {"hola":"start", "/start":"start"}
+    }, keys_to_delete)
+    if usuario:
+        return _respuesta_usuario(user_id, usuario)
+
+def _get_admin(admin_id, params):
+    return _reiniciar_usuario(admin_id, 'admin')
+
+def _get_reset(reset_id, params):
+    return _reiniciar_usuario(reset_id, 'user')
+
+def _get_setname(setnameid, params):
+    usuario = _actualizar_usuario(setnameid, {'nombre': params.get('name', None)})
+    if usuario:
+        return _respuesta_usuario(setnameid, usuario)
+
+def _get_add_admin(add_admin, params):
+    usuario = {'step': 'start', 'monto': '', 'nombre': '', 'fecha': '', 'modo': 'normal',  'cotiza': '',  'rol': 'admin'}
+    usuario['historial'] =  {"hola":"start", "/start":"start"}
+    guardar_usuario(add_admin, usuario)
+    return _respuesta_usuario(add_admin, usuario)
+
+def _get_add_developer(add_developer, params):
+    usuario = {'step': 'start', 'monto': '', 'nombre': '', 'fecha': '', 'modo': 'normal',  'rol': 'developer'}
+    usuario['historial'] =  {"hola":"start", "/start":"start"}
+    usuario['developer'] =  "ON"
+    guardar_usuario(add_developer, usuario)
+    return _respuesta_usuario(add_developer, usuario)
+
+def _get_master(master_id, params):
+    usuario = _actualizar_usuario(master_id, {
+        'historial': {"hola":"start", "/start":"start"},
+        'master': "ON",
+        'modo': "normal"
+    })
+    if usuario:
+        return _respuesta_usuario(master_id, usuario)
+
+# Rutas GET administrativas: parámetro de la query -> manejador(valor, params).
+# Se evalúan en este orden y gana la primera que produzca una respuesta.
+_GET_ROUTES = {
+    'userid': _get_usuario,
+    'adminid': _get_admin,
+    'resetid': _get_reset,
+    'setname_id': _get_setname,
+    'add_admin': _get_add_admin,
+    'add_developer': _get_add_developer,
+    'master_id': _get_master,
+}
+
+# Respuestas HTTP fijas, serializadas una sola vez. Se devuelven compartidas:
+# no deben modificarse.
+_RESP_OK = {'statusCode': 200, 'body': json.dumps({'message': 'Operación realizada correctamente'})}
+_RESP_MENSAJE_INVALIDO = {'statusCode': 200, 'body': json.dumps({'message': 'Mensaje no válido'})}
+_RESP_SIN_SENDER = {'statusCode': 200, 'body': json.dumps({'message': 'Sender not found'})}
+_RESP_IGNORADO = {'statusCode': 200, 'body': json.dumps({'status': 'ignored'})}
+_RESP_COTIZACION_REALIZADA = {'statusCode': 200, 'body': json.dumps({'message': 'Cotizacion ya realizada'})}
+_RESP_METODO_NO_PERMITIDO = {'statusCode': 405, 'body': json.dumps({'message': 'Method Not Allowed'})}
+
 def lambda_handler(event, context):
     """
     Función principal de AWS Lambda para manejar webhooks de Telegram.
@@ -498,7 +1572,7 @@ def lambda_handler(event, context):
         dict: Respuesta HTTP para Telegram
     """
 
-    print("Evento completo", event)
+    logger.debug("Evento completo %s", event)
     
     method = event['requestContext']['http']['method']
 
@@ -507,112 +1581,14 @@ def lambda_handler(event, context):
         hub_mode = params.get('hub.mode', None)
         hub_verify_token = params.get('hub.verify_token', None)
         hub_challenge = params.get('hub.challenge', None)
-        user_id = params.get('userid', None)
-        reset_id = params.get('resetid', None)
-        admin_id = params.get('adminid', None)
-        add_admin = params.get('add_admin', None)
-        add_developer = params.get('add_developer', None)
-        master_id  = params.get('master_id', None)
-        setnameid  = params.get('setname_id', None)
-        name  = params.get('name', None)
-
-        if method == 'GET' and user_id is not None:
-            user_data = recuperar_usuario(user_id)
-            if user_data:
-                print(user_data)
-                if 'bcuenta' in user_data:
-                    del user_data['bcuenta']
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps(user_data, indent=4)
-                }
-
-        if method == 'GET' and admin_id is not None:
-            usuario = recuperar_usuario(admin_id)
-            usuario['step'] = 'start'
-            usuario['rol'] = 'admin'
-            usuario['historial'] =  {"hola":"start", "/start":"start"}
-            keys_to_delete = ['bcuenta', 'documents', 'companies', 'opciones', 'base_path']
-            for key in keys_to_delete:
-                if key in usuario:
-                    del usuario[key]
-            guardar_usuario(admin_id, usuario)
-            user_data = recuperar_usuario(admin_id)
-            if user_data:
-                print(user_data)
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps(user_data, indent=4)
-                }
-
-        if method == 'GET' and reset_id is not None:
-            usuario = recuperar_usuario(reset_id)
-            usuario['step'] = 'start'
-            usuario['rol'] = 'user'
-            usuario['historial'] =  {"hola":"start", "/start":"start"}
-            keys_to_delete = ['bcuenta', 'documents', 'companies', 'opciones', 'base_path']
-            for key in keys_to_delete:
-                if key in usuario:
-                    del usuario[key]
-            guardar_usuario(reset_id, usuario)
-            user_data = recuperar_usuario(reset_id)
-            if user_data:
-                print(user_data)
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps(user_data, indent=4)
-                }
-
-        if method == 'GET' and setnameid is not None:
-            usuario = recuperar_usuario(setnameid)
-            usuario['nombre'] = name
-            guardar_usuario(setnameid, usuario)
-            user_data = recuperar_usuario(setnameid)
-            if user_data:
-                print(user_data)
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps(user_data, indent=4)
-                }
-
-        if method == 'GET' and add_admin is not None:
-            usuario = {'step': 'start', 'monto': '', 'nombre': '', 'fecha': '', 'modo': 'normal',  'cotiza': '',  'rol': 'admin'}
-            usuario['historial'] =  {"hola":"start", "/start":"start"}
-            guardar_usuario(add_admin, usuario)
-            user_data = recuperar_usuario(add_admin)
-            if user_data:
-                print(user_data)
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps(user_data, indent=4)
-                }
-
-        if method == 'GET' and add_developer is not None:
-            usuario = {'step': 'start', 'monto': '', 'nombre': '', 'fecha': '', 'modo': 'normal',  'rol': 'developer'}
-            usuario['historial'] =  {"hola":"start", "/start":"start"}
-            usuario['developer'] =  "ON"
-            guardar_usuario(add_developer, usuario)
-            user_data = recuperar_usuario(add_developer)
-            if user_data:
-                print(user_data)
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps(user_data, indent=4)
-                }
-
-        if method == 'GET' and master_id is not None:
-            usuario = recuperar_usuario(master_id)
-            usuario['historial'] =  {"hola":"start", "/start":"start"}
-            usuario['master'] =  "ON"
-            usuario['modo'] =  "normal"
-            guardar_usuario(master_id, usuario)
-            user_data = recuperar_usuario(master_id)
-            if user_data:
-                print(user_data)
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps(user_data, indent=4)
-                }
+
+        if method == 'GET':
+            for clave, manejador in _GET_ROUTES.items():
+                valor = params.get(clave, None)
+                if valor is not None:
+                    resultado = manejador(valor, params)
+                    if resultado:
+                        return resultado
 
         if method == 'GET' and hub_mode == 'subscribe' and hub_verify_token == 'VALOR_TOKEN':
             print('Token verificado correctamente')
@@ -626,7 +1602,7 @@ def lambda_handler(event, context):
                 'body': 'Token inválido o método incorrecto'
             }
     elif 'body' in event:
-        request_json = json.loads(event['body'])
+        request_json = _loads(event['body'])
         data = request_json.get('message', {})
         chat_id = str(data.get('chat', {}).get('id', ''))
         mensaje = data.get('text', '')
@@ -634,680 +1610,89 @@ def lambda_handler(event, context):
         first_name = data.get('from', {}).get('first_name', '')
         last_name = data.get('from', {}).get('last_name', '')
 
-        profile_name = first_name + " " + last_name
+        profile_name = f"{first_name} {last_name}".strip()
 
         if not chat_id or not mensaje:
-            return {
-                'statusCode': 200,
-                'body': json.dumps({'message': 'Mensaje no válido'})
-            }
+            return _RESP_MENSAJE_INVALIDO
 
-        print("chat_id:", chat_id, " ",profile_name)
+        logger.debug("chat_id: %s %s", chat_id, profile_name)
         sender = chat_id
 
-        respuesta = {}        
-
-        url_pdf = None
-        pdf_file = None
-
         mensaje=obtener_boton(data, mensaje)
 
         if (sender == ""):
-            return {
-                'statusCode': 200,
-                'body': json.dumps({'message': 'Sender not found'})
-            }
+            return _RESP_SIN_SENDER
+
+        numero_bot = "YOUR_BOT_PHONE_NUMBER"
 
-        if not (mensaje==""):
-            print("Mensaje recibido:", mensaje, " de: ",sender)
+        if sender == numero_bot: # or sender == numero_analista:
+            return _RESP_IGNORADO
 
-        usuario = {'step': 'start', 'monto': '', 'nombre': '', 'fecha': '', 'modo': 'normal',  'cotiza': ''}
-        if sender is not None and not (sender == ""):
-            usuario = recuperar_usuario(sender)
-        if not usuario and not (sender == ""):
-            if profile_name == "":
-                usuario = {'step': 'start', 'monto': '', 'nombre': '', 'fecha': '', 'modo': 'normal',  'cotiza': ''}
-            else:
-                usuario = {'step': 'start', 'monto': '', 'nombre': profile_name, 'fecha': '', 'modo': 'normal',  'cotiza': ''}
-            guardar_usuario(sender, usuario)
+        usuario = recuperar_usuario(sender) or _inicializar_usuario(sender, profile_name)
+        usuario = _normalizar_usuario(usuario)
 
         step = usuario['step']
         nombre = usuario['nombre']
-        rol = "user"
-        if 'rol' in usuario:
-            rol = usuario['rol']
-        master = "OFF"
-        if 'master' in usuario:
-            master = usuario['master']
-        developer = "OFF"
-        if 'developer' in usuario:
-            developer = usuario['developer']
+        rol = usuario['rol']
+        master = usuario['master']
+        developer = usuario['developer']
         if not (profile_name=="") and (nombre == ""):
             nombre = profile_name
-        respuesta = {}
-        botones = {}
-        opciones = {}
-
-        if isinstance(mensaje, bytes):
-            mensaje_decoded = mensaje.decode('utf-8').lower()
-        elif isinstance(mensaje, str):
-            mensaje_decoded = mensaje.lower()
-        else:
-            mensaje_decoded = str(mensaje).lower()
 
-        if isinstance(profile_name, bytes):
-            profile_name = profile_name.decode('utf-8')
-
-        profile_name = profile_name.title()
-
-        numero_bot = "YOUR_BOT_PHONE_NUMBER"
+        mensaje_decoded = mensaje.lower()
 
         adminMode=False
 
-        if sender == numero_bot: # or sender == numero_analista:
-            return jsonify({'status': 'ignored'})
-
-        if 'historial' in usuario:
-            if mensaje_decoded in usuario['historial']:
-                step = usuario['historial'][mensaje_decoded]
-                usuario['step'] = step
-                print("STEP from historial: ", step)
+        # El historial existe siempre a partir de aquí; los manejadores lo amplían en sitio.
+        historial = usuario.setdefault('historial', {})
+        if mensaje_decoded in historial:
+            step = historial[mensaje_decoded]
+            usuario['step'] = step
+            logger.debug("STEP from historial: %s", step)
         if master == "ON" and step == "start":
             step = "master"
             usuario['step'] = step
 
-        print("**********")
-        print("SENDER: ",sender)
-        print("STEP: ",step)
-        print("MODO: ",usuario['modo'])
-        print("MENSAJE: ",mensaje_decoded)
-        if 'model' in usuario and modelo_es_valido(usuario['model']):
-            print("MODELO: ",usuario['model'])
-        else:
-            print("MODELO: gpt-4o (DEFAULT)")
-        print("**********")
-
-        if False and not (step == 'start' or mensaje_decoded=="hola") and not (usuario['cotiza'] == ""):
-            return {
-                'statusCode': 200,
-                'body': json.dumps({'message': 'Cotizacion ya realizada'})
-            }
-        analista=""
-        if not (master == "ON") and (step == 'start' or mensaje_decoded=="hola" or mensaje_decoded=="/start") and not (mensaje_decoded=="chatgpt" or mensaje_decoded=="dr seguro") and (usuario['modo']=='normal'):
-            usuario['poliza'] = 'Salud'
-            usuario['cotiza'] = ""
-            if nombre == "":
-                respuesta['text'] = 'Hola, espero te encuentres bien. Soy *TUBOT*, ejecutivo virtual de *TUEMPRESA*. Es un gusto para mí atenderte para ofrecerte diferentes opciones de seguros de salud.'
-                print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file, opciones))
-                time.sleep(1)
-                respuesta['text'] = f'¿Sería tan amable de darme su nombre y apellido?'
-                usuario['step'] = 'askedWelcome'
-            else:
-                if rol == "admin":
-                    respuesta['text'] = f'Hola *{nombre}*, espero te encuentres bien. Soy *TUBOT*, ejecutivo virtual de *TUEMPRESA*.'
-                    print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file, opciones))
-                    respuesta['text'] = f'¿En qué área te puedo ayudar?'
-                    opciones = ["Riesgos","Soporte al Cliente","Administracion","Hablar con TUBOT"]
-                    usuario['historial'] = agregar_opciones(usuario.get('historial', {}), opciones, 'askedAdmin')
-                    print(enviar_mensaje_telegram(sender, respuesta['text'], None, None, None, opciones))
-                    respuesta['text'] = ''
-                    usuario['step'] = 'askedAdmin'
-                elif rol == "developer":
-                    respuesta['text'] = f'Hola *{nombre}*, soy *TUBOTSECUNDARIO*, pregúntame lo que quieras'
-                    usuario['step'] = 'waitForQuestion'
-                    usuario['modo'] = 'gandalf'
-                else:
-                    respuesta['text'] = f'Hola *{nombre}*, espero te encuentres bien. Soy *TUBOT*, ejecutivo virtual de *TUEMPRESA*. Es un gusto para mí atenderte para ofrecerte diferentes opciones de seguros de salud.'
-                    print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file, opciones))
-                    time.sleep(1)
-                    respuesta['text'] = f'¿Sería tan amable de indicarme su fecha de nacimiento?'
-                    usuario['step'] = 'askedBirthdate'
-
-        elif step == 'master':
-            usuario['poliza'] = 'Salud'
-            usuario['cotiza'] = ""
-            respuesta['text'] = f'Hola *{nombre}*, espero te encuentres bien. Soy *TUBOT*, ejecutivo virtual de *TUEMPRESA*.'
-            print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file, opciones))
-            respuesta['text'] = f'¿Con que rol quieres interactuar conmigo?'
-            if developer=="ON":
-                opciones = ["Usuario","Asociado","Master","Desarrollador"]
-            else:
-                opciones = ["Usuario","Asociado","Master"]
-            usuario['historial'] = agregar_opciones(usuario.get('historial', {}), opciones, 'askedMaster')
-            print(enviar_mensaje_telegram(sender, respuesta['text'], None, None, None, opciones))
-            respuesta['text'] = ''
-            usuario['step'] = 'askedMaster'
-
-        elif mensaje_decoded=="chatgpt" or mensaje_decoded=="dr seguro": # and adminMode:
-            respuesta['text'] = 'Estoy aqui para responder tus preguntas. Adelante.'
-            usuario['step'] = 'waitForQuestion'
-
-        elif step == 'askedWelcome' and (usuario['modo']=='normal'):
-            usuario['nombre'] = mensaje_decoded.title()
-            nombre=usuario['nombre']
-            if isinstance(usuario['nombre'], bytes):
-                nombre = usuario['nombre'].decode('utf-8')      
-            respuesta['text'] = f'Un gusto *{nombre}*. También indícame tu fecha de nacimiento:'
-            usuario['step'] = 'askedBirthdate'
-
-        elif step == 'askedBirthdate':
-            fecha=validar_fecha(mensaje_decoded)
-            if fecha:
-                usuario['fecha'] = mensaje_decoded
-                respuesta['text'] = 'Y ahora tu correo electrónico.'
-                usuario['step'] = 'askedEmail'
-            else:
-                respuesta['text'] = 'La fecha no es correcta, por favor ingresa una fecha valida (DD/MM/AAAA).'
-                usuario['step'] = 'askedBirthdate'
-
-        elif step == 'askedOnlyName':
-            usuario['nombre'] = mensaje_decoded.title()
-            usuario['step'] = 'end'
-            nombre=usuario['nombre']
-            if isinstance(usuario['nombre'], bytes):
-                nombre = usuario['nombre'].decode('utf-8')      
-            poliza=usuario['poliza']
-            data = {
-                'telefono': sender,
-                'nombre': usuario['nombre'],
-                'poliza': usuario['poliza']
-            }
-            asignar_a_analista(data)
-            respuesta['text'] = f'Gracias {nombre}, voy a dirigir tu llamada a un analista para una póliza de {poliza}. ¿Tienes alguna otra pregunta para mí?'
-            botones = {
-                "Si": "Si",
-                "No": "No",
-                "Cotiza": "Volver a cotizar"
-            }
-            usuario['step'] = 'additionalHelp'
-
-        elif step == 'askedName':
-            usuario['nombre'] = mensaje_decoded.title()
-            respuesta['text'] = 'Proporciona un correo electrónico para contactarte'     
-            usuario['step'] = 'askedEmail'
-
-        elif step == 'askedEmail':
-            if correo_es_valido(mensaje_decoded):
-                usuario['email'] = mensaje_decoded
-                respuesta['text'] = 'Por último, selecciona tu género:'
-                botones = {
-                    "M": "Masculino",
-                    "F": "Femenino"
-                }            
-                usuario['step'] = 'askedSex'
-            else:
-                respuesta['text'] = 'El correo electrónico ingresado no es válido. Por favor, ingresa un correo electrónico válido.'
-
-        elif step == 'askedSex':
-            usuario['sexo'] = mensaje_decoded
-            usuario['bcuenta']=0
-            usuario['beneficiario'] = "no"
-            respuesta['text'] = f'¿Desea agregar a un familiar a la cotización?'
-            botones = {
-                "Si": "Si",
-                "No": "No"
-            }
-            usuario['step'] = 'askBenefit'
-
-        elif step == 'askBenefit':
-            if mensaje_decoded == 'si':
-                usuario['beneficiario'] = "si"
-                respuesta['text'] = 'Escribe el parentesco (Madre, Padre, Esposo, Esposa, Hijo, Hija, Hermano o Hermana):'
-                usuario['step'] = 'askedParent'
-            else:
-                respuesta['text'] = 'Ha elegido no agregar más familiares. Procederé a preparar su cotización.'
-                botones = {
-                    "Continuar": "Continuar"
-                }
-                usuario['step'] = 'askedFamily'
-
-        elif step == 'askedParent':
-            if parentesco_valido(mensaje_decoded):
-                usuario['parentesco'] = mensaje_decoded.strip().lower()
-                parentesco=usuario['parentesco']
-                respuesta['text'] = f'Escribe la fecha de nacimiento de tu {parentesco}:'
-                usuario['step'] = 'askedBirthdateParent'
-            else:
-                respuesta['text'] = f'El parentesco no es correcto. Por favor, escribe alguna de estas opciones: Madre, Padre, Esposo, Esposa, Hijo, Hija, Hermano o Hermana'
-
-        elif step == 'askedBirthdateParent':
-            fecha=validar_fecha(mensaje_decoded)
-            if fecha:
-                usuario['bfecha'] = mensaje_decoded
-                usuario['bcuenta']=usuario['bcuenta']+1
-                data = {
-                    'btoken': sender,
-                    'bfecha': fecha_sql(usuario['bfecha']),
-                    'bparentesco': usuario['parentesco'],
-                    'correlativo': usuario['bcuenta']
-                }
-                agregar_beneficiario(data)
-                respuesta['text'] = f'¿Desea agregar a otro familiar a la cotización?'
-                botones = {
-                    "Si": "Si",
-                    "No": "No"
-                }
-                usuario['step'] = 'askBenefit'
-            else:
-                respuesta['text'] = 'La fecha no es correcta, por favor ingresa una fecha valida (DD/MM/AAAA).'
-
-        elif step == 'askedFamily':
-            usuario['bcuenta']=0
-            respuesta['text'] = 'Perfecto, en este momento le estoy enviando un cuadro de cotización para que proceda con su revisión.'
-            print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file, opciones))
-            time.sleep(1)
-            nombre=usuario['nombre']
-            usuario['plan']="Amplio"
-            usuario['monto']="100000"
-            usuario['monto2']="200000"
-            usuario['modo'] = "chatgpt"
-            usuario['step'] = "waitForQuestion"
-            guardar_usuario(sender, usuario)
-            if isinstance(usuario['nombre'], bytes):
-                nombre = usuario['nombre'].decode('utf-8')           
-            data = {
-                'telefono': sender,
-                'fecha': fecha_sql(usuario['fecha']),
-                'nombre': usuario['nombre'],
-                'email': usuario['email'],
-                'sexo': usuario['sexo'],
-                'plan': usuario['plan'],
-                'monto': usuario['monto'],
-                'monto2': usuario['monto2']
-            }            
-            id_cotizacion=cotizar(data)
-            print("Generando PDF ", id_cotizacion)
-            generar_pdf(id_cotizacion)
-            if id_cotizacion:
-                print("PDF generado con exito ", id_cotizacion)
-                usuario['cotiza']=str(id_cotizacion)
-                url_pdf = f"https://YOUR_PDF_SERVICE.co/pdfgen/{id_cotizacion}.pdf"
-                pdf_file=f"Cotizacion_{id_cotizacion}.pdf"
-                respuesta['text'] = f"Tu cotización {id_cotizacion} ya está lista. Puedes verla aquí."
-                #if sender not in polizas:
-                #    polizas[sender] = {'telefono': sender,'nombre': nombre, 'poliza': "Salud"}                   
-                print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file, opciones))
-                time.sleep(15)
-            else:
-                respuesta['text'] = "Hubo un error al procesar tu cotización."
-                url_pdf=None
-                print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file, opciones))
-
-            respuesta['text'] = "Por otro lado, le estoy enviando otras cotizaciones que puedan adaptarse a su presupuesto"
-            url_pdf=None
-            print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file,opciones))
-            time.sleep(1)
-            usuario['monto']= "50000"
-            usuario['monto2']="30000"
-            usuario['monto3']="20000"
-            usuario['plan']="Amplio"
-
-            data = {
-                'telefono': sender,
-                'fecha': fecha_sql(usuario['fecha']),
-                'nombre': usuario['nombre'],
-                'email': usuario['email'],
-                'sexo': usuario['sexo'],
-                'plan': usuario['plan'],
-                'monto': usuario['monto'],
-                'monto2': usuario['monto2'],
-                'monto3': usuario['monto3'],
-                'bdelete': "SI"
-            }            
-            id_cotizacion=cotizar(data)
-            generar_pdf(id_cotizacion)
-            if id_cotizacion:
-                url_pdf = f"https://YOUR_PDF_SERVICE.co/pdfgen/{id_cotizacion}.pdf"
-                pdf_file=f"Cotizacion_{id_cotizacion}.pdf"
-                respuesta['text'] = f"Tu cotización {id_cotizacion} ya está lista. Puedes verla aquí."
-                #if sender not in polizas:
-                #    polizas[sender] = {'telefono': sender,'nombre': nombre, 'poliza': "Salud"}                   
-                print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file,opciones))
-                time.sleep(15)
-            else:
-                respuesta['text'] = "Hubo un error al procesar tu cotización."
-                url_pdf=None
-                print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file,opciones))
-            
-            poliza=usuario['poliza']
-            data = {
-                'telefono': sender,
-                'nombre': nombre,
-                'poliza': f"Salud #{id_cotizacion}"
-            }
-            # asignar_a_analista(data)
-            url_pdf=None
-            respuesta['text'] = 'Tu cotización ha sido procesada con éxito. ¿Tienes alguna otra pregunta para mí?'
-            print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file,opciones))
-            respuesta['text'] = ''
-            usuario['modo'] = "chatgpt"
-            usuario['step'] = "waitForQuestion"
-            step = "waitForQuestion"
-            guardar_usuario(sender, usuario)
+        # Modelo del usuario resuelto una vez; el default no se guarda en el item.
+        model = usuario.get('model')
+        if not modelo_es_valido(model):
+            model = None
 
-        elif step == 'end':
-            respuesta['text'] = '¿Tienes alguna otra pregunta para mí?'
-            if usuario['poliza'] == 'Salud':
-                respuesta['text'] = 'Tu cotización ha sido procesada con éxito. ¿Tienes alguna otra pregunta para mí?'
-            if rol == "admin" or rol == "developer":
-                botones = {
-                    "Si": "Si",
-                    "No": "No",
-                    "Cotiza": "Volver"
-                }
-            else:
-                botones = {
-                    "Si": "Si",
-                    "No": "No",
-                    "Cotiza": "Volver a cotizar"
-                }                
-            usuario['step'] = 'additionalHelp'
-
-        elif step == 'additionalHelp':
-            if mensaje_decoded == 'no':
-                if rol == "admin" or rol == "developer":
-                    respuesta['text'] = '¡Gracias por contactarme! Si necesitas más ayuda en el futuro, no dudes en escribirme.'
-                else:
-                    respuesta['text'] = '¡Gracias por contactarnos! Si necesitas más ayuda en el futuro, no dudes en escribirnos.'
-                usuario['step'] = 'finalizado'
-                usuario['modo'] = 'normal'
-            if mensaje_decoded == 'volver a cotizar' or mensaje_decoded == 'volver' or mensaje_decoded.startswith('hola'):
-                if rol == "admin" or rol == "developer":
-                    respuesta['text'] = '¡Seguro! Solo escribeme *Hola* otra vez cuando quieras volver a consultar..'
-                else:
-                    respuesta['text'] = '¡Seguro! Solo escribeme *Hola* otra vez cuando quieras volver a cotizar..'
-                usuario['step'] = 'start'
-                usuario['modo'] = 'normal'
-            elif mensaje_decoded == 'si':
-                if usuario['modo'] == 'gandalf':
-                    respuesta['text'] = 'Pregúntame lo que quieras. Soy *Gandalf el Blanco*.'
-                else:
-                    respuesta['text'] = 'Por favor, escribe tu pregunta a continuación.'
-                    usuario['modo'] = 'chatgpt'
-                usuario['step'] = 'waitForQuestion'
-            else:
-                if usuario['modo'] == 'chatgpt':
-                    respuesta_chatgpt = pregunta_a_chatgpt(mensaje_decoded)
-                    if respuesta_chatgpt == "TOKEN_START":
-                        respuesta['text'] = "¡Bien! Vamos a cotizar de nuevo..."
-                        usuario['step'] = 'start'
-                        usuario['modo'] = 'normal'
-                    elif respuesta_chatgpt == "TOKEN_END":
-                        respuesta['text'] = '¡Gracias por contactarnos! Si necesitas más ayuda en el futuro, no dudes en escribirnos.'
-                        usuario['step'] = 'finalizado'
-                        usuario['modo'] = 'normal'
-                    else:
-                        respuesta['text'] = respuesta_chatgpt + "\n\n¿Tienes otra pregunta?"
-                        if rol == "admin" or rol == "developer":
-                            botones = {
-                                "Si": "Si",
-                                "No": "No",
-                                "Cotiza": "Volver"
-                            }
-                        else:
-                            botones = {
-                                "Si": "Si",
-                                "No": "No",
-                                "Cotiza": "Volver a cotizar"
-                            }
-                        usuario['step'] = 'confirmContinue'
-                else:
-                    pass
-
-        elif step == 'endCotiza':
-            respuesta['text'] = respuesta_chatgpt + "\n\n¿Tienes otra pregunta?"
-            if rol == "admin" or rol == "developer":
-                botones = {
-                    "Si": "Si",
-                    "No": "No",
-                    "Cotiza": "Volver"
-                }
-            else:
-                botones = {
-                    "Si": "Si",
-                    "No": "No",
-                    "Cotiza": "Volver a cotizar"
-                }
-            usuario['step'] = 'confirmContinue'
-
-        elif step == 'waitForQuestion':
-            model = "gpt-4o"  # Modelo por defecto
-            if not (mensaje_decoded == "continuar"):
-                if 'model' in usuario and modelo_es_valido(usuario['model']):
-                    model = usuario['model']
-                if usuario['modo'] == 'gandalf' or rol == "developer":
-                    respuesta_chatgpt = pregunta_a_gandalf(mensaje_decoded, model)
-                else:
-                    respuesta_chatgpt = pregunta_a_chatgpt(mensaje_decoded, model)
-                mensajes = dividir_mensaje(respuesta_chatgpt)
-                for respuesta_chatgpt in mensajes:
-                    enviar_mensaje_telegram(sender, respuesta_chatgpt, None, None, None, None)
-                    time.sleep(1)                
-                respuesta['text'] = "¿Tienes otra pregunta?"
-                if rol == "admin" or rol == "developer":
-                    botones = {
-                        "Si": "Si",
-                        "No": "No",
-                        "Cotiza": "Volver"
-                    }
-                else:
-                    botones = {
-                        "Si": "Si",
-                        "No": "No",
-                        "Cotiza": "Volver a cotizar"
-                    }            
-                usuario['step'] = 'additionalHelp'
-
-        elif step == 'confirmContinue':
-            if mensaje_decoded == 'si':
-                respuesta['text'] = '¡Muy bien! Haz tu próxima pregunta.'
-                usuario['step'] = 'additionalHelp'
-                usuario['modo'] = 'chatgpt'
-            if mensaje_decoded == 'cotiza':
-                respuesta['text'] = '¡Seguro! Podemos volver a cotizar.'
-                usuario['step'] = 'start'
-                usuario['modo'] = 'normal'
-            else:
-                respuesta['text'] = '¡Gracias por contactarnos! Si necesitas más ayuda en el futuro, no dudes en escribirnos.'
-                usuario['step'] = 'finalizado'
-                usuario['modo'] = 'normal'
+        logger.info(json.dumps({
+            'sender': sender,
+            'step': step,
+            'modo': usuario['modo'],
+            'mensaje': mensaje_decoded,
+            'model': model or f'{_MODELO_DEFAULT} (DEFAULT)'
+        }, ensure_ascii=False))
 
-        elif step == 'askedAdmin':
-            respuesta['text'] = '¿En qué subárea te puedo ayudar?'
-            usuario['step'] = 'start'
-            usuario['modo'] == 'normal'
-            if mensaje_decoded in ['administracion', 'riesgos', 'soporte al cliente']:
-                usuario['categoria'] = mensaje_decoded
-                suboptions = {
-                    'administracion': ["Aranceles", "Relacion Comisiones", "Pago Comisiones", "Contacto"],
-                    'riesgos': ["Condicionados", "Métodos Pago", "Requisitos Cotizar", "Requisitos Emitir", "Requ. cotizar colectivo", "Requ. cotizar flota", "Solicitudes",'Edad de admisibilidad','Plazos de espera'],
-                    'soporte al cliente': ["Red clinicas", "Proc. Reclamos", "Tramitar Recl.", "Contactos Emerg."]
-                }
-                opciones = suboptions[mensaje_decoded]
-                usuario['historial'] = agregar_opciones(usuario.get('historial', {}), opciones, 'sub_category_selection')
-                usuario['opciones'] = opciones
-                respuesta['text'] = "Selecciona una subcategoría:"
-                usuario['step'] = 'sub_category_selection'
-            if mensaje_decoded == 'hablar con deyna':
-                respuesta['text'] = 'Estoy aqui para responder tus preguntas. Adelante.'
-                opciones = {}
-                print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file, opciones))
-                usuario['step'] = 'waitForQuestion'
-                usuario['modo'] == 'chatgpt'
-                respuesta['text'] = ''
-        elif step == 'askedMaster':
-            if mensaje_decoded=="usuario":
-                respuesta['text'] = 'Hola, espero te encuentres bien. Soy *TUBOT*, ejecutivo virtual de *TUEMPRESA*. Es un gusto para mí atenderte para ofrecerte diferentes opciones de seguros de salud.'
-                print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file, opciones))
-                time.sleep(1)
-                respuesta['text'] = f'¿Sería tan amable de darme su nombre y apellido?'
-                usuario['rol'] == 'user'
-                usuario['modo'] == 'normal'
-                usuario['step'] = 'askedWelcome'
-            if mensaje_decoded=="asociado":
-                respuesta['text'] = f'¿En qué área te puedo ayudar?'
-                opciones = ["Riesgos","Soporte al Cliente","Administracion","Hablar con TUBOT"]
-                usuario['historial'] = agregar_opciones(usuario.get('historial', {}), opciones, 'askedAdmin')
-                print(enviar_mensaje_telegram(sender, respuesta['text'], None, None, None, opciones))
-                respuesta['text'] = ''
-                usuario['rol'] == 'admin'
-                usuario['step'] = 'askedAdmin'
-                usuario['modo'] == 'normal'
-            if mensaje_decoded=="desarrollador" and developer=="ON":
-                respuesta['text'] = f'Hola *{nombre}*, soy *TUBOTSECUNDARIO*, pregúntame lo que quieras'
-                usuario['rol'] == 'developer'
-                usuario['step'] = 'waitForQuestion'
-                usuario['modo'] = 'gandalf'
-            if mensaje_decoded=="master":
-                respuesta['text'] = '¡Hola Maestro! ¿Que nueva instrucción o sugerencia quieres que aprenda?'
-                usuario['step'] = 'askedTrainer'
-
-        elif step == 'askedTrainer':
-            respuesta['text'] = 'Memorizando. Espera un momento por favor...'
-            print(enviar_mensaje_telegram(sender, respuesta['text'], None, None, None, None))
-            user_data = recuperar_usuario("deyna")
-            instrucciones = ""
-            if user_data and 'instrucciones' in user_data:
-                user_data['instrucciones']=user_data['instrucciones']+"\n"+mensaje_decoded
-                guardar_usuario("deyna", user_data)
-                time.sleep(1)
-                response = pregunta_a_chatgpt("TUBOT:reborn")
-                respuesta['text'] = 'Mi base de conocimiento ha sido actualizada con éxito.'
-                usuario['step'] = 'master'
-            else:
-                respuesta['text'] = 'Mi base de conocimiento no tiene instrucciones. Algo anda mal con mi servidor.'
-                usuario['step'] = 'master'
+        if False and not (step == 'start' or mensaje_decoded=="hola") and not (usuario['cotiza'] == ""):
+            return _RESP_COTIZACION_REALIZADA
 
-        elif step == 'gandalf':
-            respuesta['text'] = 'Estoy aqui para responder tus preguntas. Adelante.'
-            opciones = {}
-            print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file, opciones))
-            usuario['step'] = 'waitForQuestion'
-            usuario['modo'] == 'gandalf'
-            respuesta['text'] = ''
-        elif step == 'sub_category_selection':
-            if usuario['categoria'] in ['administracion', 'riesgos', 'soporte al cliente']:
-                usuario['subcategoria'] = mensaje_decoded
-                if mensaje_decoded in ['condicionados', 'métodos pago', 'solicitudes','red clinicas']:
-                    usuario['step'] = 'company_selection'
-                    # Define companies based on the subcategory
-                    companies = {
-                        'conicionados': ['Compania1', 'Compania2', 'Compania3', 'Compania4', 'Compania5', 'Compania6', 'Compania7', 'Compania8', 'Compania9', 'Compania10'],
-                        'red clinicas': ['Compania1', 'Compania2', 'Compania3', 'Compania4', 'Compania5', 'Compania6', 'Compania7', 'Compania8', 'Compania9', 'Compania10'],
-                        'métodos pago': ['Compania1', 'Compania2', 'Compania3', 'Compania4', 'Compania5', 'Compania6', 'Compania7', 'Compania8', 'Compania9', 'Compania10'],
-                        'solicitudes': ['Compania1', 'Compania2', 'Compania3', 'Compania4', 'Compania5', 'Compania6', 'Compania7', 'Compania8', 'Compania9', 'Compania10']
-                    }                    
-                    usuario['companies'] = companies.get(mensaje_decoded, [])
-                    opciones = usuario['companies']
-                    usuario['historial'] = agregar_opciones(usuario.get('historial', {}), opciones, 'company_selection')
-                    respuesta['text'] = "Selecciona una aseguradora:"
-                else:
-                    print ("ELEGIR: ",usuario['categoria'], ",", mensaje_decoded, ",", usuario['subcategoria'])
-                    documento, tipo, base_path = elegir_documento(usuario['categoria'], mensaje_decoded)
-                    usuario['base_path'] = base_path
-                    if tipo == 'list':
-                        usuario['documents'] = documento                        
-                        print("1:",base_path,"2:",documento)                        
-                        opciones = documento
-                        usuario['historial'] = agregar_opciones(usuario.get('historial', {}), opciones, 'document_choice')
-                        respuesta['text'] = "Selecciona un archivo o carpeta:" 
-                        usuario['step'] = 'document_choice'
-                    elif tipo == 'single':
-                        url_pdf = documento
-                        if 'base_path' in usuario and usuario['base_path'] is not None:
-                            url_pdf=usuario['base_path']+url_pdf
-                        pdf_file = f"{mensaje_decoded[:22]}.pdf"
-                        respuesta['text'] = f"Aquí está el documento que solicitaste"
-                        usuario['step'] = 'start'                    
-                    else:
-                        respuesta['text'] = "Opción no válida. Selecciona una opción válida."
-            else:
-                respuesta['text'] = "Subcategoría no reconocida. Elige una opción válida."
-        elif step == 'company_selection':
-            documento, tipo, base_path = elegir_documento(usuario['categoria'], usuario['subcategoria'], mensaje_decoded)
-            usuario['base_path'] = base_path
-            if tipo == 'list':
-                usuario['documents'] = documento
-                print("1:",base_path,"2:",documento)
-                usuario['base_path'] = base_path
-                opciones = documento
-                usuario['historial'] = agregar_opciones(usuario.get('historial', {}), opciones, 'document_choice')
-                respuesta['text'] = "Selecciona un archivo o carpeta:" 
-                usuario['step'] = 'document_choice'
-            elif tipo == 'single':
-                url_pdf = documento
-                if 'base_path' in usuario and usuario['base_path'] is not None:
-                    url_pdf=usuario['base_path']+url_pdf
-                pdf_file = f"{mensaje_decoded}.pdf"
-                respuesta['text'] = f"Aquí está el documento que solicitaste"
-                usuario['step'] = 'start'                    
-            else:
-                respuesta['text'] = "Opción no válida. Selecciona una opción válida."
-        elif step == 'document_choice':
-            selected_doc = usuario['documents'].get(mensaje_decoded, None)
-            if selected_doc:
-                print("Documento seleccionado: ",selected_doc)
-                if selected_doc.endswith("pdf"):
-                    print("Termina en PDF")
-                    url_pdf = selected_doc
-                    pdf_file = f"{mensaje_decoded}"
-                    respuesta['text'] = f"Aquí está el documento que solicitaste"
-                    botones = {}
-                    opciones = {}
-                    usuario['step'] = 'start'
-                else:
-                    print("No termina en PDF")
-                    folder_path = usuario['base_path'].rstrip('/') + '/' + mensaje_decoded.lstrip('/')
-                    print("obtener_documentos(",folder_path,")")
-                    documentos = obtener_documentos(folder_path.replace("https://YOUR_DOCUMENT_SERVICE.co/doc_asist/", ""))
-                    if documentos:
-                        if not folder_path.endswith("/"):
-                            folder_path=folder_path+"/"
-                        documentos_urls = {doc: f"{folder_path}{doc}" for doc in documentos}
-                        usuario['documents'] = documentos_urls
-                        opciones = documentos_urls
-                        usuario['historial'] = agregar_opciones(usuario.get('historial', {}), opciones, 'document_choice')
-                        respuesta['text'] = "Selecciona un archivo o carpeta:" 
-                        usuario['step'] = 'document_choice'
-                    else:
-                        respuesta['text'] = "Documento no válido o carpeta vacia. Intente de nuevo."
-                        usuario['step'] = 'start'
-            else:
-                folder_path = usuario['base_path'].rstrip('/') + '/' + mensaje_decoded.lstrip('/')
-                print("obtener_documentos(",folder_path,")")
-                documentos = obtener_documentos(folder_path.replace("https://YOUR_DOCUMENT_SERVICE.co/doc_asist/", ""))
-                if documentos:
-                    if not folder_path.endswith("/"):
-                        folder_path=folder_path+"/"
-                    documentos_urls = {doc: f"{folder_path}{doc}" for doc in documentos}
-                    usuario['documents'] = documentos_urls
-                    opciones = documentos_urls
-                    usuario['historial'] = agregar_opciones(usuario.get('historial', {}), opciones, 'document_choice')
-                    respuesta['text'] = "Selecciona un archivo o carpeta:" 
-                    usuario['step'] = 'document_choice'
-                else:
-                    respuesta['text'] = "Documento no válido o carpeta vacia. Intente de nuevo."
-                    usuario['step'] = 'start'
+        ctx = Contexto(sender, usuario, mensaje_decoded, nombre, rol, developer, model=model or _MODELO_DEFAULT)
+        if not (master == "ON") and (step == 'start' or mensaje_decoded=="hola" or mensaje_decoded=="/start") and not (mensaje_decoded=="chatgpt" or mensaje_decoded=="dr seguro") and (usuario['modo']=='normal'):
+            manejador = _h_start
+        elif step != 'master' and (mensaje_decoded=="chatgpt" or mensaje_decoded=="dr seguro"):
+            manejador = _h_chatgpt
         else:
-            respuesta['text'] = 'No entiendo tu mensaje. Escribe *hola* para empezar de nuevo.'
-            usuario['step'] = 'start'
-            usuario['modo'] = 'normal'
-        if 'text' in respuesta and not (respuesta['text'] == ''):
-            print(enviar_mensaje_telegram(sender, respuesta['text'], botones, url_pdf, pdf_file, opciones))
+            manejador = STEP_HANDLERS.get(step, _h_desconocido)
+        manejador(ctx)
+
+        # La respuesta a Telegram y el guardado del usuario son independientes:
+        # se solapan, pero se esperan ambos porque la Lambda se congela al retornar.
+        envio = None
+        if ctx.texto:
+            envio = _enviar_async(sender, ctx.texto, ctx.botones, ctx.url_pdf, ctx.pdf_file, ctx.opciones)
 
         if sender is not None and not (sender == "") and usuario:
             guardar_usuario(sender, usuario)
+        if envio is not None:
+            envio.result()
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps({'message': 'Operación realizada correctamente'})
-        }
+        return _RESP_OK
 
     else:
-        return {
-            'statusCode': 405,
-            'body': json.dumps({'message': 'Method Not Allowed'})
-        }
+        return _RESP_METODO_NO_PERMITIDO
 
 
 def registrar_log(data):
@@ -0,0 +1,67 @@
+"""
+Pruebas de la espera del PDF publicado (_esperar_pdf).
+
+Se ejecutan con: python -m unittest discover telegram
+"""
+
+import os
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import lambda_function as lf
+
+
+class _Servidor(BaseHTTPRequestHandler):
+    """Servidor HTTP plano: /redir.pdf redirige a /1.pdf, que responde 200."""
+    peticiones = 0
+
+    def do_HEAD(self):
+        type(self).peticiones += 1
+        if self.path == '/redir.pdf':
+            self.send_response(302)
+            self.send_header('Location', '/1.pdf')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class EsperarPdfTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.servidor = ThreadingHTTPServer(('127.0.0.1', 0), _Servidor)
+        cls.puerto = cls.servidor.server_address[1]
+        threading.Thread(target=cls.servidor.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.servidor.shutdown()
+        cls.servidor.server_close()
+
+    def setUp(self):
+        _Servidor.peticiones = 0
+
+    def test_tls_contra_puerto_sin_tls_termina_en_plazo(self):
+        inicio = time.monotonic()
+        disponible = lf._esperar_pdf(f'https://127.0.0.1:{self.puerto}/1.pdf')
+        transcurrido = time.monotonic() - inicio
+        self.assertFalse(disponible)
+        self.assertLess(transcurrido, lf._PDF_ESPERA_MAX + 1.0)
+        # Un intento por paso del backoff, sin reintentos internos de urllib3.
+        self.assertLessEqual(_Servidor.peticiones, len(lf._PDF_ESPERAS) + 1)
+
+    def test_sigue_redirecciones(self):
+        self.assertTrue(lf._esperar_pdf(f'http://127.0.0.1:{self.puerto}/redir.pdf'))
+        self.assertEqual(_Servidor.peticiones, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()